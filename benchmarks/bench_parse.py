@@ -0,0 +1,68 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import textwrap
+import bs4
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import config
+import scrape
+
+
+def parse_soup(html):
+    soup = bs4.BeautifulSoup(html, "lxml")
+    df = scrape.extract_dataframe(soup)
+    company = scrape.extract_company(soup)
+    next_found = soup.find(name="a", string="次へ") is not None
+    return df, company, next_found
+
+
+def check_same(html):
+    df, company, next_found = parse_soup(html)
+    columns, _company, _next_found = scrape.parse_history(html)
+    assert company == _company, (company, _company)
+    assert next_found == _next_found
+    assert (np.array(df['date'].tolist(), dtype=columns['date'].dtype) == columns['date']).all()
+    for field in ['start', 'end', 'low', 'high', 'volumn', 'end_adj', 'div']:
+        assert (np.array(df[field].tolist(), dtype='float64') == columns[field]).all(), field
+
+
+def time_parser(parser, htmls, repeat):
+    timings = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for html in htmls:
+            parser(html)
+        timings.append(time.perf_counter() - t)
+    return min(timings) / len(htmls)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Compare the BeautifulSoup and the lxml parsers of history pages
+                             over saved pages, after checking that they agree.
+                             """))
+    parser.add_argument('-DIR', default=os.path.join(config.path_root, 'fixtures', 'history'),
+                        help='The directory of saved history pages')
+    parser.add_argument('-REPEAT', default=5, type=int,
+                        help='The number of repetitions, of which the best is reported')
+
+    args = parser.parse_args()
+    htmls = []
+    for path in sorted(glob.glob(os.path.join(args.DIR, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            htmls.append(f.read())
+    for html in htmls:
+        check_same(html)
+
+    t_soup = time_parser(parse_soup, htmls, args.REPEAT)
+    t_lxml = time_parser(scrape.parse_history, htmls, args.REPEAT)
+    print('{} pages'.format(len(htmls)))
+    print('BeautifulSoup: {:8.3f} ms/page'.format(t_soup * 1e3))
+    print('lxml:          {:8.3f} ms/page'.format(t_lxml * 1e3))
+    print('speedup:       {:8.1f} x'.format(t_soup / t_lxml))
@@ -0,0 +1,238 @@
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import datetime
+import tempfile
+import argparse
+import textwrap
+import tracemalloc
+import collections
+import bs4
+import numpy as np
+import xlsxwriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import config
+import calc
+import extract
+import panel
+import postprocess
+import scrape
+import visualize
+import synthetic
+
+# Times each hot path over synthetic universes of several sizes, measures
+# the peak memory it allocates in a second pass under tracemalloc, writes
+# the results as JSON and flags the stages slower or larger than a baseline.
+
+SCALES = collections.OrderedDict([
+    ('small',  (180,  0.5)),
+    ('medium', (1000, 3)),
+    ('large',  (4000, 10)),
+])
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def measure(func, repeat=1, memory=True):
+    '''
+    Returns:
+        dict: the best wall and CPU seconds over `repeat` calls,
+            the number of items `func` returned it processed and
+            the peak bytes allocated during one more call.
+    '''
+    result = {'wall': float('inf'), 'cpu': float('inf')}
+    for _ in range(repeat):
+        gc.collect()
+        t_wall, t_cpu = time.perf_counter(), time.process_time()
+        n_items = func()
+        result['wall'] = min(result['wall'], time.perf_counter() - t_wall)
+        result['cpu'] = min(result['cpu'], time.process_time() - t_cpu)
+    result['items'] = n_items
+    result['per_item'] = result['wall'] / max(n_items, 1)
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def stages(prices, codes, sample, start_date, end_date, tmp_dir):
+    '''
+    The stages to measure as name -> function returning the number of
+    items processed. Stages too slow to run over the whole universe
+    run over its first `sample` codes and are compared per item.
+    '''
+    sampled = codes[:sample]
+    pages = [page for code in sampled for page in
+             synthetic.make_history_pages(code, prices.name(code), prices.read(code))]
+    report_start = str(np.datetime64(end_date, 'D') - 182)
+    frames = [postprocess.calculate_indicators(
+        extract.dict2dataframe(extract.extract_data(prices, code, report_start, end_date))) for code in sampled]
+
+    def extract_codes():
+        for code in codes:
+            extract.dict2dataframe(extract.extract_data(prices, code, start_date, end_date))
+        return len(codes)
+
+    def indicators():
+        for code in codes:
+            postprocess.calculate_indicators(
+                extract.dict2dataframe(extract.extract_data(prices, code, start_date, end_date)))
+        return len(codes)
+
+    def load_panel():
+        universe = panel.Panel.load(prices, codes, start_date, end_date)
+        for code in codes:
+            universe.frame(code)
+        return len(codes)
+
+    def calc_batch():
+        universe = panel.Panel.load(prices, codes, start_date, end_date)
+        calc.calc_batch(universe.matrix('end_adj'))
+        return len(codes)
+
+    def parse_lxml():
+        for html in pages:
+            scrape.parse_history(html)
+        return len(pages)
+
+    def parse_soup():
+        for html in pages:
+            scrape.extract_dataframe(bs4.BeautifulSoup(html, 'lxml'))
+        return len(pages)
+
+    def render():
+        renderer = visualize.ChartRenderer()
+        path = os.path.join(tmp_dir, 'chart.png')
+        for df in frames:
+            renderer.draw_candlestick(df, path)
+            renderer.draw_indicators(df, ['macd', 'signal'], path)
+            renderer.draw_indicators(df, ['D', 'D_slow'], path)
+        renderer.close()
+        return len(frames)
+
+    def xlsx():
+        workbook = xlsxwriter.Workbook(os.path.join(tmp_dir, 'bench.xlsx'), {'constant_memory': True})
+        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        for i, df in enumerate(frames):
+            postprocess.insert_df_to_xlsx(df, workbook.add_worksheet(str(i)), date_format)
+        workbook.close()
+        return len(frames)
+
+    return collections.OrderedDict([
+        ('extract', extract_codes),
+        ('panel', load_panel),
+        ('indicators', indicators),
+        ('calc_batch', calc_batch),
+        ('parse_lxml', parse_lxml),
+        ('parse_soup', parse_soup),
+        ('render', render),
+        ('xlsx', xlsx),
+    ])
+
+
+def run_scale(n_codes, n_years, sample, repeat, memory, seed):
+    end_date = '2019-05-31'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        t = time.perf_counter()
+        prices, codes = synthetic.write_universe(os.path.join(tmp_dir, 'store'), n_codes, n_years, seed, end_date)
+        results = collections.OrderedDict([('generate', {'wall': time.perf_counter() - t, 'items': n_codes})])
+        start_date = str(synthetic.business_days(n_years, end_date)[0])
+        for name, func in stages(prices, codes, sample, start_date, end_date, tmp_dir).items():
+            results[name] = measure(func, repeat, memory)
+            print('  {:<12} {:9.3f} s {:10.3f} ms/item {:>12} B'.format(
+                name, results[name]['wall'], results[name]['per_item'] * 1e3,
+                results[name].get('peak_bytes', '-')))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns:
+        list of str: the stages slower per item or larger in peak memory
+            than in the baseline by more than `tolerance`.
+    '''
+    regressions = []
+    for scale, scale_results in results['scales'].items():
+        for stage, result in scale_results['stages'].items():
+            base = baseline.get('scales', {}).get(scale, {}).get('stages', {}).get(stage)
+            if base is None:
+                continue
+            for key in ['per_item', 'peak_bytes']:
+                if key in result and key in base and result[key] > base[key] * (1 + tolerance):
+                    regressions.append('{}/{} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(
+                        scale, stage, key, base[key], result[key], result[key] / base[key] - 1))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Measure the time and the memory of each stage over synthetic universes,
+                             write the results as JSON and compare them with a baseline.
+                             Scales: {}.
+                             """.format(', '.join('{} ({} codes, {} years)'.format(k, *v) for k, v in SCALES.items()))))
+    parser.add_argument('-SCALES', nargs='+', default=['small'], choices=list(SCALES),
+                        help='The sizes of universe to measure')
+    parser.add_argument('-SAMPLE', default=20, type=int,
+                        help='The number of codes parsed, rendered and written to excel')
+    parser.add_argument('-REPEAT', default=1, type=int,
+                        help='The number of repetitions, of which the best is reported')
+    parser.add_argument('-SEED', default=0, type=int,
+                        help='The seed of the synthetic universe')
+    parser.add_argument('-NOMEMORY', action='store_true',
+                        help='Skip the measurement of memory')
+    parser.add_argument('-OUT', default=None,
+                        help='The JSON file of the results, by default in results/bench')
+    parser.add_argument('-BASELINE', default=BASELINE_PATH,
+                        help='The JSON file of the results compared with')
+    parser.add_argument('-TOLERANCE', default=0.25, type=float,
+                        help='The relative increase over the baseline flagged as a regression')
+    parser.add_argument('-UPDATE_BASELINE', action='store_true',
+                        help='Replace the baseline with the results of this run')
+
+    args = parser.parse_args()
+
+    results = {'meta': {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'machine': platform.platform(),
+                        'seed': args.SEED, 'sample': args.SAMPLE, 'repeat': args.REPEAT},
+               'scales': collections.OrderedDict()}
+    for scale in args.SCALES:
+        n_codes, n_years = SCALES[scale]
+        print('{}: {} codes, {} years'.format(scale, n_codes, n_years))
+        results['scales'][scale] = {'n_codes': n_codes, 'n_years': n_years,
+                                    'stages': run_scale(n_codes, n_years, args.SAMPLE, args.REPEAT,
+                                                        not args.NOMEMORY, args.SEED)}
+
+    out = args.OUT
+    if out is None:
+        out = os.path.join(config.res_dir_path, 'bench', 'bench_{}.json'.format(
+            datetime.datetime.now().strftime('%Y%m%d_%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written in', out)
+
+    if args.UPDATE_BASELINE:
+        with open(args.BASELINE, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('baseline written in', args.BASELINE)
+    elif os.path.exists(args.BASELINE):
+        with open(args.BASELINE) as f:
+            regressions = compare(results, json.load(f), args.TOLERANCE)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('no regression against', args.BASELINE)
+    else:
+        print('no baseline at', args.BASELINE)
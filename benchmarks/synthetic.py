@@ -0,0 +1,146 @@
+import os
+import sys
+import datetime
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import store
+
+# Deterministic synthetic universes of daily prices and the history pages
+# they would be scraped from. The same seed always gives the same prices.
+#
+# Columns follow the order of a history page: the store fields 'end' and
+# 'high' hold the 2nd and the 4th price columns (高値 and 終値) as scraped.
+
+ROWS_PER_PAGE = 20
+
+
+def business_days(n_years, end_date="2019-05-31"):
+    end = np.datetime64(end_date, 'D')
+    start = end - int(round(365.25 * n_years))
+    days = np.arange(start + 1, end + 1, dtype='datetime64[D]')
+    return days[np.is_busday(days)]
+
+
+def make_code(code, n_years, seed=0, end_date="2019-05-31", split_rate=0.2):
+    '''
+    Generate the bars of a code over `n_years` years.
+
+    Args:
+        code (str): the stock code, which also seeds the generator.
+        split_rate (float): the expected number of stock splits per year.
+    Returns:
+        dict: column name -> 1-D array sorted by date, as PriceStore.read.
+    '''
+    rs = np.random.RandomState([seed, int(code)])
+    dates = business_days(n_years, end_date)
+    n = len(dates)
+    close = rs.uniform(300, 10000) * np.exp(np.cumsum(rs.normal(0, 0.015, n)))
+    open = close * np.exp(rs.normal(0, 0.005, n))
+    high = np.maximum(open, close) * np.exp(np.abs(rs.normal(0, 0.005, n)))
+    low = np.minimum(open, close) * np.exp(-np.abs(rs.normal(0, 0.005, n)))
+    # a split at a bar multiplies the prices before it by the ratio,
+    # the adjusted close is the close of today's shares
+    div = (rs.uniform(size=n) < split_rate / 250).astype(store.DTYPES['div'])
+    factor = np.cumprod(np.where(div[::-1] == 1, 2., 1.))[::-1]
+    raw = [np.round(v * factor) for v in (open, high, low, close)]
+    return {'date': dates,
+            'start': raw[0],
+            'end': raw[1],
+            'low': raw[2],
+            'high': raw[3],
+            'volumn': rs.randint(1000, 10000000, n).astype(store.DTYPES['volumn']),
+            'end_adj': np.round(close),
+            'div': div}
+
+
+def make_codes(n_codes):
+    return [str(1000 + i) for i in range(n_codes)]
+
+
+def write_universe(root, n_codes, n_years, seed=0, end_date="2019-05-31"):
+    '''
+    Write a synthetic universe into a PriceStore one code at a time.
+
+    Returns:
+        PriceStore: the store.
+        list of str: the codes.
+    '''
+    prices = store.PriceStore(root)
+    codes = make_codes(n_codes)
+    for code in codes:
+        prices.write(code, "銘柄{}".format(code), make_code(code, n_years, seed, end_date))
+    return prices, codes
+
+
+def _format_date(date):
+    d = date.astype(datetime.date)
+    return '{}年{}月{}日'.format(d.year, d.month, d.day)
+
+
+def make_history_pages(code, name, columns):
+    '''
+    Render the bars of a code as Yahoo-style history pages,
+    newest first, with a row announcing each stock split.
+
+    Returns:
+        list of str: the pages in order.
+    '''
+    rows = []
+    for i in range(len(columns['date']) - 1, -1, -1):
+        if columns['div'][i] and i < len(columns['date']) - 1:
+            rows.append('<tr>\n<td>{}</td>\n<td colspan="6" class="through">分割: 1株 -> 2株</td>\n</tr>'
+                        .format(_format_date(columns['date'][i+1])))
+        cells = [_format_date(columns['date'][i])] + ['{:,}'.format(int(columns[field][i])) for field in
+                                                      ['start', 'end', 'low', 'high', 'volumn', 'end_adj']]
+        rows.append('<tr>\n' + ''.join('<td>{}</td>\n'.format(cell) for cell in cells) + '</tr>')
+    n_pages = max(1, -(-len(rows) // ROWS_PER_PAGE))
+    pages = []
+    for page in range(1, n_pages + 1):
+        links = []
+        if page > 1:
+            links.append('<a href="{}?code={}.T&amp;p={}">前へ</a>'.format(HISTORY_URL, code, page - 1))
+        if page < n_pages:
+            links.append('<a href="{}?code={}.T&amp;p={}">次へ</a>'.format(HISTORY_URL, code, page + 1))
+        pages.append(PAGE.format(name=name, code=code,
+                                 rows='\n'.join(rows[(page-1)*ROWS_PER_PAGE:page*ROWS_PER_PAGE]),
+                                 links='\n'.join(links)))
+    return pages
+
+
+HISTORY_URL = "https://info.finance.yahoo.co.jp/history/"
+
+PAGE = '''<!DOCTYPE html>
+<html lang="ja">
+<head>
+<meta charset="utf-8">
+<title>{name}【{code}】：時系列 - Yahoo!ファイナンス</title>
+</head>
+<body>
+<div id="main">
+<div class="padT12 marB10 clearFix">
+<table class="stocksTable" summary="株価詳細">
+<tr>
+<th class="symbol"><h1>{name}</h1></th>
+</tr>
+</table>
+</div>
+<table width="100%" border="0" cellspacing="0" cellpadding="0" class="boardFin yjSt marB6">
+<tr>
+<th width="20%">日付</th>
+<th width="12%">始値</th>
+<th width="12%">高値</th>
+<th width="12%">安値</th>
+<th width="12%">終値</th>
+<th width="12%">出来高</th>
+<th width="20%">調整後終値*</th>
+</tr>
+{rows}
+</table>
+<ul class="ymuiPagingBottom clearFix">
+{links}
+</ul>
+</div>
+</body>
+</html>
+'''
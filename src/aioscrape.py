@@ -0,0 +1,218 @@
+import time
+import asyncio
+import itertools
+import urllib.parse
+import concurrent.futures
+from logging import getLogger
+import scrape
+import metrics
+
+
+logger = getLogger(__name__)
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) \
+    AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+
+
+class RateLimiter(object):
+    '''
+    Space out requests to the same host by at least 1/rate seconds.
+    A rate of 0 or None disables the limit.
+    '''
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._next = {}
+
+    async def wait(self, url):
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        now = asyncio.get_event_loop().time()
+        slot = max(now, self._next.get(host, now))
+        self._next[host] = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+
+class AdaptiveLimiter(object):
+    '''
+    Bound the number of requests in flight by a limit adapted to the site:
+    the limit grows by one every `limit` successful requests answered within
+    `latency` seconds and halves on a failure or a slower answer,
+    between 1 and `maximum`, as TCP adapts its congestion window.
+    '''
+
+    def __init__(self, maximum, latency=2.):
+        self.maximum = maximum
+        self.latency = latency
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._condition = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, ok, latency=0.):
+        async with self._condition:
+            self.in_flight -= 1
+            self.update(ok and latency <= self.latency)
+            self._condition.notify_all()
+
+    def update(self, ok):
+        previous = int(self.limit)
+        if ok:
+            self.limit = min(float(self.maximum), self.limit + 1. / self.limit)
+        else:
+            self.limit = max(1., self.limit / 2)
+        if int(self.limit) != previous:
+            logger.info('concurrency: {} -> {}'.format(previous, int(self.limit)))
+            metrics.count('concurrency_raised' if ok else 'concurrency_lowered')
+
+
+async def fetch(session, url, throttle, limiter):
+    await throttle.acquire()
+    ok, t = False, time.perf_counter()
+    try:
+        await limiter.wait(url)
+        t = time.perf_counter()
+        async with session.get(url) as response:
+            response.raise_for_status()
+            body = await response.read()
+            html = await response.text()
+        ok = True
+    finally:
+        latency = time.perf_counter() - t
+        await throttle.release(ok, latency)
+    metrics.observe('request_latency', latency)
+    metrics.count('pages_fetched')
+    metrics.count('bytes_downloaded', len(body))
+    return html
+
+
+def is_retryable(e):
+    import aiohttp
+
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, ValueError))
+
+
+async def fetch_page(session, url, code, throttle, limiter, executor, cache=None, retry=None):
+    '''
+    The coroutine version of scrape.fetch_page: fetch and parse a page
+    with retries, caching it only once it has been parsed.
+    '''
+    loop = asyncio.get_event_loop()
+    retry = scrape.Retry() if retry is None else retry
+    use_cache = cache is not None
+    for attempt in itertools.count():
+        html = cache.get(url) if use_cache else None
+        from_cache = html is not None
+        try:
+            if from_cache:
+                metrics.count('cache_hits')
+            else:
+                with metrics.wall_stage('fetch', code):
+                    html = await fetch(session, url, throttle, limiter)
+            try:
+                parsed = metrics.unwrap(
+                    await loop.run_in_executor(executor, metrics.collecting(scrape.parse_page), html, code))
+            except ValueError:
+                if not from_cache:
+                    # a page without prices is what a throttled request gets
+                    throttle.update(False)
+                raise
+        except Exception as e:
+            if attempt >= retry.retries or not is_retryable(e) or (from_cache and cache.offline):
+                raise
+            use_cache = cache is not None and not from_cache
+            delay = retry.delay(attempt)
+            metrics.count('retries')
+            logger.warning('retrying {} in {:.1f}s after {}: {}'.format(url, delay, type(e).__name__, e))
+            await asyncio.sleep(delay)
+            continue
+        if cache is not None and not from_cache:
+            cache.put(url, html)
+        return parsed
+
+
+async def scrape_code(session, code, start_date, end_date, throttle, limiter, executor,
+                      base_url=None, cache=None, retry=None, journal=None):
+    page = 1
+    pages = []
+    next_found = True
+    while next_found:
+        saved = journal.load_page(code, page) if journal is not None else None
+        if saved is not None:
+            columns, company, next_found = saved
+        else:
+            logger.info("code: {}, page: {}".format(code, page))
+            url = scrape.specify_url(code, start_date, end_date, page, base_url)
+            columns, company, next_found = await fetch_page(
+                session, url, code, throttle, limiter, executor, cache, retry)
+            if journal is not None:
+                journal.save_page(code, page, columns, company, next_found)
+        pages.append(columns)
+        page += 1
+    return company, scrape.concat_columns(pages)
+
+
+async def scrape_safely(on_result, session, code, *args):
+    try:
+        company, columns = await scrape_code(session, code, *args)
+    except Exception:
+        logger.exception('failed to scrape {}'.format(code))
+        company, columns = None, None
+    on_result(code, company, columns)
+
+
+async def scrape_all(codes, start_date, end_date, on_result, concurrency=8, latency=2., rate=10.,
+                     n_parsers=2, base_url=None, start_dates=None, cache=None, retry=None, journal=None):
+    '''
+    Scrape many codes concurrently over pooled keep-alive connections.
+
+    Args:
+        codes (list of str): stock codes.
+        start_date (str): the start date formatted as 'YYYY-MM-DD'.
+        end_date (str): the end date formatted as 'YYYY-MM-DD'.
+        on_result (callable): called with the code, the company name and the columns
+            of the period as soon as each code is done. The name and the columns
+            are None if the code failed, which does not affect the others.
+        concurrency (int): the maximum number of requests in flight. The limit
+            actually applied adapts to the latency and the failures of the site.
+        latency (float): the seconds above which an answer lowers the limit.
+        rate (float): the maximum number of requests per second to a host.
+        n_parsers (int): the number of processes parsing pages.
+        base_url (str): the url of the history site.
+        start_dates (dict): code -> start date overriding `start_date`.
+        cache (cache.PageCache): a page cache consulted before fetching.
+        retry (scrape.Retry): the retries and the timeout of a request.
+        journal (journal.Journal): the progress of the run, whose saved pages are not fetched.
+    '''
+    import aiohttp
+
+    start_dates = {} if start_dates is None else start_dates
+    retry = scrape.Retry() if retry is None else retry
+    throttle = AdaptiveLimiter(concurrency, latency)
+    limiter = RateLimiter(rate)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=retry.timeout)
+    with concurrent.futures.ProcessPoolExecutor(n_parsers) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=client_timeout,
+                                         headers=HEADERS) as session:
+            await asyncio.gather(*[
+                scrape_safely(on_result, session, code, start_dates.get(code, start_date), end_date,
+                              throttle, limiter, executor, base_url, cache, retry, journal)
+                for code in codes])
+
+
+def run(codes, start_date, end_date, on_result, **kwargs):
+    # the coroutines fetching pages interleave,
+    # so the event loop as a whole is profiled as the fetch stage
+    with metrics.profiling('fetch'):
+        asyncio.run(scrape_all(codes, start_date, end_date, on_result, **kwargs))
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import indicators
+
+# Bookkeeping of incremental report builds. The manifest records a hash of
+# the input of each code: its bars in the report period, its name and the
+# parameters of the indicators. A code whose hash is unchanged reuses the
+# indicator frame and the charts of the last build.
+
+# bump to invalidate every build, e.g. when charts are drawn differently
+BUILD_VERSION = 1
+
+
+def window_hash(name_base, columns):
+    '''
+    Args:
+        name_base (str): the name of the sheet and the charts of the code.
+        columns (dict): column name -> 1-D array of the bars in the period.
+    Returns:
+        str: a hex digest of everything the materials of the code depend on.
+    '''
+    h = hashlib.sha256()
+    params = {"version": BUILD_VERSION, "name": name_base,
+              "defaults": sorted(indicators.defaults().items()), "outputs": indicators.outputs()}
+    h.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for field in sorted(columns):
+        h.update(field.encode("utf-8"))
+        h.update(np.ascontiguousarray(columns[field]).tobytes())
+    return h.hexdigest()
+
+
+def save_frame(path, df):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, index=df.index.values, columns=np.array(df.columns, dtype=str),
+             **{"column_{}".format(i): df[c].values for i, c in enumerate(df.columns)})
+    os.replace(tmp_path, path)
+
+
+def load_frame(path):
+    with np.load(path) as data:
+        columns = list(data["columns"])
+        return pd.DataFrame({c: data["column_{}".format(i)] for i, c in enumerate(columns)},
+                            index=pd.DatetimeIndex(data["index"]), columns=columns)
+
+
+class Manifest(object):
+    '''
+    code -> hash of the input of the code in the last build, kept in a JSON file.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.hashes = json.load(f)
+        else:
+            self.hashes = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.hashes, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,64 @@
+import os
+import time
+import hashlib
+import datetime
+import tempfile
+import urllib.parse
+
+
+class CacheMissError(LookupError):
+    pass
+
+
+class PageCache(object):
+    '''
+    Content-addressed on-disk cache of history pages keyed by url.
+
+    A page whose whole period ends before today can never change and is
+    served forever. A page covering today is served for `ttl` seconds.
+    In offline mode every cached page is served regardless of its age
+    and a missing page raises CacheMissError instead of being fetched.
+    '''
+
+    def __init__(self, root, ttl=600., offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.offline = offline
+
+    def get(self, url):
+        '''
+        Return the cached page of a url, or None if it must be fetched.
+        '''
+        path = self.path(url)
+        if os.path.exists(path):
+            if self.offline or is_immutable(url) or time.time() - os.path.getmtime(path) < self.ttl:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return f.read()
+        if self.offline:
+            raise CacheMissError('{} is not cached'.format(url))
+        return None
+
+    def put(self, url, html):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(html)
+        os.replace(tmp_path, path)
+
+    def path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, key[:2], key + '.html')
+
+
+def is_immutable(url, today=None):
+    '''
+    Whether the period of a history page url ends before today.
+    '''
+    today = datetime.date.today() if today is None else today
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    try:
+        end = datetime.date(int(query['ey'][0]), int(query['em'][0]), int(query['ed'][0]))
+    except (KeyError, ValueError):
+        return False
+    return end < today
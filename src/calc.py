@@ -1,7 +1,10 @@
 import numpy as np
 
+# block length of the blocked linear filter used by the exponential average
+EMA_BLOCK = 128
+
 def calc_macd(v, n_short=12, n_long=26):
-    v_avg_short = calc_avg_exp(v, n_short)        
+    v_avg_short = calc_avg_exp(v, n_short)
     v_avg_long = calc_avg_exp(v, n_long)
     v_macd = v_avg_short - v_avg_long
     return v_macd
@@ -10,53 +13,150 @@ def calc_signal(v, n_signal=9, n_short=12, n_long=26):
     v_macd = calc_macd(v, n_short, n_long)
     v_signal = calc_avg_exp(v_macd, n_signal)
     return v_signal
-    
+
 def calc_D_slow(v, n_K=5, n_D=3, n_D_slow=3):
     v_D = calc_D(v, n_K, n_D)
     v_D_slow = calc_avg_simple(v_D, n_D_slow)
     return v_D_slow
 
-def calc_D(v, n_K=5, n_D=3):
-    v_K_numer = np.zeros_like(v, dtype="float32")
-    v_K_denom = np.zeros_like(v, dtype="float32")
-    for i in range(len(v)):
-        if i < n_K-1:
-            v_K_numer[i] = np.nan
-            v_K_denom[i] = np.nan
-        else:
-            v_over_n_K = v[i-(n_K-1):i+1]
-            v_K_numer[i] = v[i] - np.min(v_over_n_K)
-            v_K_denom[i] = np.max(v_over_n_K) - np.min(v_over_n_K)
-    v_K_numer_avg = calc_avg_simple(v_K_numer, n_D)
-    v_K_denom_avg = calc_avg_simple(v_K_denom, n_D)
-    v_K = 100 * v_K_numer_avg / v_K_denom_avg
-    return v_K
-
-def calc_avg_simple(v, n):
-    v_avg = np.zeros_like(v, dtype="float32")
-    for i in range(len(v)):
-        if i < n-1:
-            v_avg[i] = np.nan
-        else:
-            v_over_n = v[i-(n-1):i+1]
-            if np.isnan(v_over_n).any():
-                v_avg[i] = np.nan
-            else:
-                v_avg[i] = np.mean(v_over_n)
-    return v_avg
-
-def calc_avg_exp(v, n):
-    v_avg = np.zeros_like(v, dtype="float32")
-    for i in range(len(v)):
-        if i < n-1:
-            v_avg[i] = np.nan
-        else:
-            v_over_n = v[i-(n-1):i+1]
-            if np.isnan(v_over_n).any():
-                v_avg[i] = np.nan
-            else:
-                if np.isnan(v_avg[i-1]):
-                    v_avg[i] = np.mean(v_over_n)
-                else:
-                    v_avg[i] = (2*v[i] + (n-1)*v_avg[i-1]) / (n+1)
-    return v_avg
\ No newline at end of file
+def calc_D(v, n_K=5, n_D=3, dtype="float32"):
+    m, shape = _as_matrix(v)
+    m_min = _rolling_min(m, n_K)
+    m_max = -_rolling_min(-m, n_K)
+    m_K_numer = m - m_min
+    m_K_denom = m_max - m_min
+    m_K_numer_avg = _avg_simple(m_K_numer, n_D)
+    m_K_denom_avg = _avg_simple(m_K_denom, n_D)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m_K = 100 * m_K_numer_avg / m_K_denom_avg
+    return m_K.astype(dtype).reshape(shape)
+
+def calc_avg_simple(v, n, dtype="float32"):
+    m, shape = _as_matrix(v)
+    m_avg = _avg_simple(m, n)
+    return m_avg.astype(dtype).reshape(shape)
+
+def calc_avg_exp(v, n, dtype="float32"):
+    m, shape = _as_matrix(v)
+    m_avg = _avg_exp(m, n)
+    return m_avg.astype(dtype).reshape(shape)
+
+def judge(macd, signal, D_slow, low=20, high=80):
+    '''
+    Judge whether a code is promising from its indicators on a day.
+
+    Returns:
+        str: "BUY", "SELL" or "STAY".
+    '''
+    if macd >= 0 and macd > signal and D_slow <= low:
+        return "BUY"
+    elif macd <= 0 and macd < signal and D_slow >= high:
+        return "SELL"
+    else:
+        return "STAY"
+
+def judge_batch(m_macd, m_signal, m_D_slow, low=20, high=80):
+    '''
+    Judge every element of arrays of indicators at once as `judge` does.
+
+    Returns:
+        np.ndarray: boolean array, True where it is "BUY".
+        np.ndarray: boolean array, True where it is "SELL".
+    '''
+    with np.errstate(invalid='ignore'):
+        buy = (m_macd >= 0) & (m_macd > m_signal) & (m_D_slow <= low)
+        sell = (m_macd <= 0) & (m_macd < m_signal) & (m_D_slow >= high)
+    return buy, sell
+
+def calc_batch(m, n_short=12, n_long=26, n_signal=9, n_K=5, n_D=3, n_D_slow=3):
+    '''
+    Calculate all the indicators for a universe of codes at once.
+
+    Args:
+        m (np.ndarray): a 2-D array of prices whose rows are codes and
+            whose columns are dates.
+    Returns:
+        dict: 2-D float32 arrays of 'macd', 'signal', 'D' and 'D_slow'
+            with the same shape as `m`.
+    '''
+    m = np.asarray(m, dtype="float64")
+    if m.ndim != 2:
+        raise ValueError("expected a 2-D (codes x dates) array, got {}-D".format(m.ndim))
+    m_macd = calc_macd(m, n_short, n_long)
+    m_signal = calc_avg_exp(m_macd, n_signal)
+    m_D = calc_D(m, n_K, n_D)
+    m_D_slow = calc_avg_simple(m_D, n_D_slow)
+    return {"macd": m_macd, "signal": m_signal, "D": m_D, "D_slow": m_D_slow}
+
+def _as_matrix(v):
+    # every kernel works on rows of a (series x dates) float64 matrix
+    a = np.asarray(v, dtype="float64")
+    return np.atleast_2d(a), a.shape
+
+def _window_sum(m, n):
+    # sum and NaN count over the trailing n elements via cumulative sums
+    nans = np.isnan(m)
+    c_sum = np.cumsum(np.where(nans, 0., m), axis=1)
+    c_nan = np.cumsum(nans, axis=1)
+    s = c_sum.copy()
+    s[:, n:] -= c_sum[:, :-n]
+    k = c_nan.copy()
+    k[:, n:] -= c_nan[:, :-n]
+    valid = k == 0
+    valid[:, :n-1] = False
+    return s, valid
+
+def _avg_simple(m, n):
+    s, valid = _window_sum(m, n)
+    return np.where(valid, s / n, np.nan)
+
+def _avg_exp(m, n):
+    # an average is seeded with the simple average of the first complete
+    # window after every NaN gap and then follows the recursion
+    # y[i] = (2*v[i] + (n-1)*y[i-1]) / (n+1) until the next gap
+    alpha = 2. / (n + 1)
+    s, valid = _window_sum(m, n)
+    seeds = valid.copy()
+    seeds[:, 1:] &= ~valid[:, :-1]
+    segments = np.cumsum(seeds, axis=1)
+    m_avg = np.full(m.shape, np.nan)
+    for k in range(1, segments.max(initial=0) + 1):
+        in_segment = valid & (segments == k)
+        b = np.where(in_segment & seeds, s / n, np.where(in_segment, alpha * m, 0.))
+        y = _linear_filter(b, 1. - alpha)
+        m_avg[in_segment] = y[in_segment]
+    return m_avg
+
+def _linear_filter(b, c):
+    # y[i] = c*y[i-1] + b[i] along rows, evaluated block by block with a
+    # lower triangular matrix of powers of c so as to stay numerically stable
+    n_block = min(EMA_BLOCK, b.shape[1])
+    if n_block == 0:
+        return b.copy()
+    lags = np.arange(n_block)
+    powers = np.tril(c ** np.clip(lags[:, None] - lags[None, :], 0, None))
+    carry = c ** (lags + 1)
+    y = np.empty_like(b)
+    y_prev = np.zeros(b.shape[0])
+    for i in range(0, b.shape[1], n_block):
+        b_block = b[:, i:i+n_block]
+        n = b_block.shape[1]
+        y_block = b_block @ powers[:n, :n].T + y_prev[:, None] * carry[None, :n]
+        y[:, i:i+n] = y_block
+        y_prev = y_block[:, -1]
+    return y
+
+def _rolling_min(m, n):
+    # van Herk/Gil-Werman: O(1) per element whatever the window length.
+    # NaN propagates through np.minimum as it does through np.min.
+    n_rows, n_cols = m.shape
+    out = np.full(m.shape, np.nan)
+    if n_cols < n:
+        return out
+    n_pad = -n_cols % n
+    padded = np.concatenate([m, np.full((n_rows, n_pad), np.inf)], axis=1)
+    blocks = padded.reshape(n_rows, -1, n)
+    prefix = np.minimum.accumulate(blocks, axis=2).reshape(n_rows, -1)
+    suffix = np.minimum.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(n_rows, -1)
+    out[:, n-1:] = np.minimum(suffix[:, :n_cols-n+1], prefix[:, n-1:n_cols])
+    return out
@@ -16,10 +16,28 @@ codes = ['1605', '1801', '1802', '1812', '1878', '1925', '1928', '2181', '2269',
          '8802', '8830', '8927', '9020', '9021', '9022', '9064', '9101', '9104', '9201', '9202', '9432',
          '9433', '9437', '9501', '9503', '9531', '9613', '9684', '9735', '9766', '9843', '9983', '9984']
 
+
+def read_codes(path):
+    '''
+    Read a universe from a file of one code per line, e.g. the whole exchange,
+    to replace `codes`. Blank lines and what follows a # are ignored.
+    '''
+    with open(path, 'r') as f:
+        return [code for code in (line.split('#')[0].strip() for line in f) if code]
+
+
+history_url = "https://info.finance.yahoo.co.jp/history/"
+
 path_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
 res_dir_path = os.path.join(path_root, "results")
 
 json_path  = os.path.join(res_dir_path, "stock_prices.json")
+store_path = os.path.join(res_dir_path, "store")
+cache_dir_path = os.path.join(res_dir_path, "cache")
+journal_dir_path = os.path.join(res_dir_path, "journal")
+queue_path = os.path.join(res_dir_path, "queue.sqlite")
+socket_path = os.path.join(res_dir_path, "query.sock")
+build_dir_path = os.path.join(res_dir_path, "build")
 xlsx_path  = os.path.join(res_dir_path, "stock_prices.xlsx")
 c_dir_path = os.path.join(res_dir_path, "candle")
 m_dir_path = os.path.join(res_dir_path, "macd")
@@ -1,25 +1,34 @@
 import os
 import sys
-import json
 import datetime
 from dateutil.relativedelta import relativedelta
 import argparse
 import textwrap
+import numpy as np
 import pandas as pd
 import config
+import store
 
-def extract_data(data, code, date_start, date_end):
-    d1 = datetime.datetime.strptime(date_start, "%Y-%m-%d")
-    d2 = datetime.datetime.strptime(date_end,   "%Y-%m-%d")
-    dates = {(d1 + datetime.timedelta(i)).strftime("%Y-%m-%d") for i in range((d2-d1).days + 1)}
-    data_focus = {k: data[code]['data'][k] for k in data[code]['data'].keys() & dates}
+def extract_data(prices, code, date_start, date_end):
+    return extract_many(prices, [code], date_start, date_end)[code]
+
+def extract_many(prices, codes, date_start, date_end):
+    # dates of a code are sorted, so a period is a contiguous slice
+    # found by binary search and the columns are views of the store
+    d1 = np.datetime64(date_start, 'D')
+    d2 = np.datetime64(date_end,   'D')
+    data_focus = {}
+    for code in codes:
+        columns = prices.read(code)
+        i1 = np.searchsorted(columns['date'], d1, side='left')
+        i2 = np.searchsorted(columns['date'], d2, side='right')
+        data_focus[code] = {k: v[i1:i2] for k, v in columns.items()}
     return data_focus
 
 def dict2dataframe(data):
-    df = pd.DataFrame(data).T
-    df.index = pd.to_datetime(df.index)
-    df = df.dropna().apply(pd.to_numeric) # deal with stock division
-    df = df.sort_index()
+    index = pd.to_datetime(data['date'].astype('datetime64[ns]'))
+    df = pd.DataFrame({field: data[field] for field, dtype in store.FIELDS[1:]}, index=index)
+    df = df.dropna() # deal with stock division
     return df
 
 if __name__ == '__main__':
@@ -30,8 +39,8 @@ if __name__ == '__main__':
                              Extract stock price data from the database.
                              Specification of stock code is mandatory but period is optional.
                              """))
-    parser.add_argument('CODE', 
-                        help='The stock code of which you want to extract the stock price data')
+    parser.add_argument('CODE', nargs='+',
+                        help='The stock codes of which you want to extract the stock price data')
     parser.add_argument('-START', default=None,
                         help='The date from when to extract stock prices. Its format must be YYYY-MM-DD')
     parser.add_argument('-END', default=None,
@@ -52,10 +61,11 @@ if __name__ == '__main__':
     date_end = datetime_end.strftime('%Y-%m-%d')
     date_start = datetime_start.strftime('%Y-%m-%d')
     
-    with open(config.json_path, "r") as f:
-        data = json.load(f)    
+    prices = store.open_store()
         
-    data_focus = extract_data(data, args.CODE, date_start, date_end)
-    df = dict2dataframe(data_focus)
-    
-    print(df)
\ No newline at end of file
+    data_focus = extract_many(prices, args.CODE, date_start, date_end)
+    for code in args.CODE:
+        df = dict2dataframe(data_focus[code])
+        if len(args.CODE) > 1:
+            print(code)
+        print(df)
\ No newline at end of file
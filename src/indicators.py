@@ -0,0 +1,101 @@
+import collections
+import calc
+
+# Indicators declare the series they are calculated from and their
+# parameters. A Pipeline calculates each of them at most once per series,
+# so intermediates shared by several indicators are not recalculated.
+#
+# An input is either another indicator, a column of the DataFrame given
+# to the Pipeline, or "price", the column the Pipeline is calculated over.
+
+REGISTRY = collections.OrderedDict()
+
+
+def register(name, inputs, params=None, output=False):
+    '''
+    Register an indicator calculated by the decorated function.
+
+    Args:
+        name (str): the name of the indicator.
+        inputs (list of str): the inputs passed positionally to the function.
+        params (dict): parameter name -> default value passed as keywords.
+        output (bool): whether calculate_indicators adds it as a column.
+    '''
+    def decorator(func):
+        REGISTRY[name] = (func, tuple(inputs), dict(params or {}), output)
+        return func
+    return decorator
+
+
+def defaults():
+    params = {}
+    for func, inputs, _params, output in REGISTRY.values():
+        params.update(_params)
+    return params
+
+
+def outputs():
+    return [name for name, (func, inputs, params, output) in REGISTRY.items() if output]
+
+
+class Pipeline(object):
+    '''
+    Calculate registered indicators over a column of a DataFrame,
+    memoizing every indicator calculated on the way.
+    '''
+
+    def __init__(self, df, price="end_adj", **params):
+        unknown = set(params) - set(defaults())
+        if unknown:
+            raise TypeError("unknown parameters: {}".format(", ".join(sorted(unknown))))
+        self.df = df
+        self.price = price
+        self.params = defaults()
+        self.params.update(params)
+        self.memo = {}
+
+    def __getitem__(self, name):
+        if name not in self.memo:
+            self.memo[name] = self._calculate(name)
+        return self.memo[name]
+
+    def calculate(self, names):
+        return {name: self[name] for name in names}
+
+    def _calculate(self, name):
+        if name == "price":
+            return self.df[self.price].values
+        if name not in REGISTRY:
+            return self.df[name].values
+        func, inputs, params, output = REGISTRY[name]
+        return func(*[self[i] for i in inputs], **{p: self.params[p] for p in params})
+
+
+@register("ema_short", ["price"], {"n_short": 12})
+def ema_short(v, n_short):
+    return calc.calc_avg_exp(v, n_short)
+
+
+@register("ema_long", ["price"], {"n_long": 26})
+def ema_long(v, n_long):
+    return calc.calc_avg_exp(v, n_long)
+
+
+@register("macd", ["ema_short", "ema_long"], output=True)
+def macd(v_avg_short, v_avg_long):
+    return v_avg_short - v_avg_long
+
+
+@register("signal", ["macd"], {"n_signal": 9}, output=True)
+def signal(v_macd, n_signal):
+    return calc.calc_avg_exp(v_macd, n_signal)
+
+
+@register("D", ["price"], {"n_K": 5, "n_D": 3}, output=True)
+def D(v, n_K, n_D):
+    return calc.calc_D(v, n_K, n_D)
+
+
+@register("D_slow", ["D"], {"n_D_slow": 3}, output=True)
+def D_slow(v_D, n_D_slow):
+    return calc.calc_avg_simple(v_D, n_D_slow)
@@ -0,0 +1,67 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import numpy as np
+import store
+
+
+class Journal(object):
+    '''
+    Progress of a scrape run, so that an interrupted run resumes where it stopped.
+
+    Every page parsed is saved as `{code}_{page}.npz` by whichever process
+    scraped it, and every code saved to the database is appended to
+    `done.jsonl` by the single writer. A code in `done.jsonl` is skipped
+    and a page already saved is not fetched again.
+    The journal of a run is identified by its period and site.
+    '''
+
+    def __init__(self, root, start_date, end_date, base_url=None, fresh=False):
+        key = hashlib.sha1('{} {} {}'.format(start_date, end_date, base_url).encode('utf-8')).hexdigest()
+        self.path = os.path.join(root, key[:16])
+        if fresh:
+            self.clear()
+        os.makedirs(self.path, exist_ok=True)
+
+    def done_codes(self):
+        path = os.path.join(self.path, 'done.jsonl')
+        if not os.path.exists(path):
+            return set()
+        with open(path, 'r') as f:
+            # a line cut by an interruption is ignored
+            return {json.loads(line)['code'] for line in f if line.endswith('\n')}
+
+    def mark_done(self, code, n_rows):
+        with open(os.path.join(self.path, 'done.jsonl'), 'a') as f:
+            f.write(json.dumps({'code': code, 'rows': n_rows}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        for path in glob.glob(os.path.join(self.path, '{}_*.npz'.format(code))):
+            os.remove(path)
+
+    def load_page(self, code, page):
+        '''
+        Returns:
+            tuple: the columns, the company name and whether a next page exists
+                as scrape.parse_history returns them, or None if not saved.
+        '''
+        path = self._page_path(code, page)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            columns = {field: data[field] for field, dtype in store.FIELDS}
+            return columns, str(data['company']), bool(data['next_found'])
+
+    def save_page(self, code, page, columns, company, next_found):
+        path = self._page_path(code, page)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, company=company, next_found=next_found, **columns)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _page_path(self, code, page):
+        return os.path.join(self.path, '{}_{}.npz'.format(code, page))
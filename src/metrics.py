@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import datetime
+import glob
+import config
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# Collect wall and CPU time per stage and per code, counters and latency
+# histograms, and write them as a JSON report at the end of a run.
+#
+# Nothing is collected until `enable` is called: `stage` then returns a
+# shared no-op context and `count` and `observe` return at once.
+# A function run in worker processes is wrapped by `collecting` and its
+# results are passed through `merged` (or `unwrap`) by the parent, which
+# adds what each call collected in the worker to the metrics of the run.
+
+# names the report and the profiles of this run
+RUN = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+# upper bounds in seconds of the buckets of latency histograms
+BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float("inf")]
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, metrics, name, code):
+        self.metrics = metrics
+        self.name = name
+        self.code = code
+        self.profile = metrics.profiles.get(name)
+
+    def __enter__(self):
+        if self.profile is not None:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # another profiler is active, e.g. that of an enclosing stage
+                self.profile = None
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        if self.profile is not None:
+            self.profile.disable()
+        self.metrics.add_time(self.name, self.code, wall, cpu)
+        return False
+
+
+class _WallStage(object):
+
+    def __init__(self, metrics, name, code):
+        self.metrics = metrics
+        self.name = name
+        self.code = code
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, self.code, time.perf_counter() - self.wall, 0.)
+        return False
+
+
+class _Profiling(object):
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        try:
+            self.profile.enable()
+        except ValueError:
+            self.profile = None
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+        return False
+
+
+def peak_rss_kb():
+    '''
+    Return the peak resident memory of this process in KiB,
+    or 0 where it is not available.
+    '''
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+class Metrics(object):
+    '''
+    Metrics of one process. Times are [count, wall seconds, CPU seconds]
+    and the peak resident memory is in KiB on every platform.
+    '''
+
+    def __init__(self, profile=(), profile_dir=None):
+        self.pid = os.getpid()
+        self.profile_dir = profile_dir
+        self.profiles = {name: cProfile.Profile() for name in profile}
+        self.clear()
+
+    def clear(self):
+        self.stages = {}
+        self.codes = {}
+        self.counters = {}
+        self.histograms = {}
+        self.peak_rss_kb = 0
+        self.worker_peak_rss_kb = 0
+
+    def stage(self, name, code=None):
+        return _Stage(self, name, code)
+
+    def add_time(self, name, code, wall, cpu):
+        _add_time(self.stages, name, [1, wall, cpu])
+        if code is not None:
+            _add_time(self.codes.setdefault(str(code), {}), name, [1, wall, cpu])
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.setdefault(name, [0] * len(BUCKETS))
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        self.peak_rss_kb = max(self.peak_rss_kb, peak_rss_kb())
+        self.dump_profiles()
+        return {"stages": self.stages, "codes": self.codes, "counters": self.counters,
+                "histograms": self.histograms, "peak_rss_kb": self.peak_rss_kb}
+
+    def merge(self, snapshot):
+        for name, times in snapshot["stages"].items():
+            _add_time(self.stages, name, times)
+        for code, stages in snapshot["codes"].items():
+            for name, times in stages.items():
+                _add_time(self.codes.setdefault(code, {}), name, times)
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+        for name, counts in snapshot["histograms"].items():
+            histogram = self.histograms.setdefault(name, [0] * len(BUCKETS))
+            self.histograms[name] = [a + b for a, b in zip(histogram, counts)]
+        self.worker_peak_rss_kb = max(self.worker_peak_rss_kb, snapshot["peak_rss_kb"])
+
+    def dump_profiles(self):
+        # one file per stage and process, merged by `report`
+        if self.profile_dir is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for name, profile in self.profiles.items():
+            if profile.getstats():
+                profile.dump_stats(os.path.join(self.profile_dir, "{}.{}.prof".format(name, os.getpid())))
+
+    def report(self, path, **info):
+        '''
+        Write the metrics of the run as JSON, with `info` as is,
+        and merge the profiles of each stage into {profile_dir}/{stage}.prof.
+        '''
+        snapshot = self.snapshot()
+        report = dict(info)
+        report["stages"] = {name: {"count": n, "wall": wall, "cpu": cpu}
+                            for name, (n, wall, cpu) in sorted(snapshot["stages"].items())}
+        report["codes"] = {code: {name: {"count": n, "wall": wall, "cpu": cpu}
+                                  for name, (n, wall, cpu) in sorted(stages.items())}
+                           for code, stages in sorted(snapshot["codes"].items())}
+        report["counters"] = dict(sorted(snapshot["counters"].items()))
+        report["histograms"] = {name: {"buckets": [str(b) for b in BUCKETS], "counts": counts}
+                                for name, counts in sorted(snapshot["histograms"].items())}
+        report["peak_rss_kb"] = {"main": snapshot["peak_rss_kb"],
+                                 "workers": self.worker_peak_rss_kb}
+        if self.profile_dir is not None:
+            report["profiles"] = {}
+            for name in self.profiles:
+                paths = glob.glob(os.path.join(self.profile_dir, "{}.*.prof".format(name)))
+                if paths:
+                    merged = os.path.join(self.profile_dir, "{}.prof".format(name))
+                    pstats.Stats(*paths).dump_stats(merged)
+                    for p in paths:
+                        os.remove(p)
+                    report["profiles"][name] = merged
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def _add_time(stages, name, times):
+    total = stages.setdefault(name, [0, 0., 0.])
+    for i, t in enumerate(times):
+        total[i] += t
+
+
+_metrics = None
+
+
+def enable(profile=(), profile_dir=None):
+    '''
+    Start collecting metrics in this process.
+
+    Args:
+        profile (list of str): stages run under cProfile.
+        profile_dir (str): the directory of the profiles.
+    '''
+    global _metrics
+    _metrics = Metrics(profile, profile_dir)
+    return _metrics
+
+
+def disable():
+    global _metrics
+    _metrics = None
+
+
+def enabled():
+    return _metrics is not None
+
+
+def stage(name, code=None):
+    '''
+    A context timing a stage, of a code if given.
+    '''
+    if _metrics is None:
+        return _NULL_STAGE
+    return _metrics.stage(name, code)
+
+
+def wall_stage(name, code=None):
+    '''
+    A context timing only the wall time of a stage, for a stage which awaits:
+    its CPU time and its profile would include every coroutine run meanwhile.
+    Its CPU time is reported as 0.
+    '''
+    if _metrics is None:
+        return _NULL_STAGE
+    return _WallStage(_metrics, name, code)
+
+
+def profiling(name):
+    '''
+    A context running a whole block under the profile of a stage if it is
+    profiled, e.g. an event loop whose coroutines interleave in that stage.
+    '''
+    if _metrics is None or name not in _metrics.profiles:
+        return _NULL_STAGE
+    return _Profiling(_metrics.profiles[name])
+
+
+def count(name, n=1):
+    if _metrics is not None:
+        _metrics.count(name, n)
+
+
+def observe(name, seconds):
+    if _metrics is not None:
+        _metrics.observe(name, seconds)
+
+
+class _Collecting(object):
+
+    def __init__(self, func, profile, profile_dir):
+        self.func = func
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.parent_pid = os.getpid()
+
+    def __call__(self, *args, **kwargs):
+        if os.getpid() == self.parent_pid:
+            # called by the parent itself, which collects directly
+            return self.func(*args, **kwargs), None
+        if _metrics is None or _metrics.pid != os.getpid():
+            # the metrics of a worker live as long as the worker,
+            # not those inherited from the parent by fork
+            enable(self.profile, self.profile_dir)
+        _metrics.clear()
+        result = self.func(*args, **kwargs)
+        return result, _metrics.snapshot()
+
+
+def collecting(func):
+    '''
+    Wrap a function called in worker processes so that it also returns
+    what it collected, if metrics are enabled. Otherwise return it as is.
+    '''
+    if _metrics is None:
+        return func
+    return _Collecting(func, list(_metrics.profiles), _metrics.profile_dir)
+
+
+def unwrap(result):
+    '''
+    Merge what a function wrapped by `collecting` collected and return its result.
+    '''
+    if _metrics is None:
+        return result
+    result, snapshot = result
+    if snapshot is not None:
+        _metrics.merge(snapshot)
+    return result
+
+
+def merged(results):
+    for result in results:
+        yield unwrap(result)
+
+
+def profile_dir(program):
+    return os.path.join(config.res_dir_path, "metrics", "{}_{}_profiles".format(program, RUN))
+
+
+def write_report(program, **info):
+    '''
+    Write the report of the run into results/metrics.
+
+    Returns:
+        str: the path of the report.
+    '''
+    path = os.path.join(config.res_dir_path, "metrics", "{}_{}.json".format(program, RUN))
+    _metrics.report(path, program=program, **info)
+    return path
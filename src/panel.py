@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import extract
+import store
+
+# Typed (codes x dates) arrays of a universe over a period, aligned on the
+# union of the trading days of its codes.
+
+PRICE_FIELDS = ['start', 'end', 'low', 'high', 'end_adj']
+DTYPES = dict(store.DTYPES, **{field: 'float32' for field in PRICE_FIELDS})
+
+
+class Panel(object):
+    '''
+    Every field of a universe as one 2-D array whose rows are codes and
+    whose columns are the dates of the panel.
+
+    Attributes:
+        codes (list of str): the codes in the order of the rows.
+        dates (np.ndarray): the sorted datetime64[D] dates of the columns.
+        fields (dict): field name -> 2-D array, float32 for prices, int64 for
+            the volume and int8 for the split flag. Prices are NaN and the
+            others 0 where a code has no bar.
+        present (np.ndarray): boolean mask of the bars a code has.
+        valid (np.ndarray): boolean mask of the bars without a missing price,
+            i.e. the present bars except the split rows of old databases,
+            which are the rows dict2dataframe keeps.
+    '''
+
+    def __init__(self, codes, dates, fields, present, period=None):
+        self.codes = list(codes)
+        self.dates = dates
+        self.fields = fields
+        self.present = present
+        with np.errstate(invalid='ignore'):
+            self.valid = present & ~np.any([np.isnan(fields[f]) for f in PRICE_FIELDS], axis=0)
+        self.rows = {code: i for i, code in enumerate(self.codes)}
+        self.period = period
+
+    @classmethod
+    def load(cls, prices, codes, date_start, date_end):
+        data_focus = extract.extract_many(prices, codes, date_start, date_end)
+        dates = np.unique(np.concatenate([np.empty(0, dtype=store.DTYPES['date'])] +
+                                         [data_focus[code]['date'] for code in codes]))
+        shape = len(codes), len(dates)
+        fields = {field: np.full(shape, np.nan, dtype=DTYPES[field]) if field in PRICE_FIELDS
+                  else np.zeros(shape, dtype=DTYPES[field])
+                  for field, dtype in store.FIELDS[1:]}
+        present = np.zeros(shape, dtype=bool)
+        for i, code in enumerate(codes):
+            data = data_focus[code]
+            j = np.searchsorted(dates, data['date'])
+            present[i, j] = True
+            for field, m in fields.items():
+                m[i, j] = data[field]
+        return cls(codes, dates, fields, present, (date_start, date_end))
+
+    def matrix(self, field='end_adj', dtype='float64'):
+        '''
+        A field as a (codes x dates) array, NaN where a bar is not valid,
+        as calc.calc_batch and screen.screen_panel take it.
+        '''
+        m = self.fields[field].astype(dtype)
+        m[~self.valid] = np.nan
+        return m
+
+    def view(self, code):
+        '''
+        The valid bars of a code as column name -> 1-D array.
+        The arrays are views of the panel unless the code lacks a valid
+        bar on some date between its first and last valid bars,
+        e.g. while suspended, in which case they are copies.
+        '''
+        i = self.rows[code]
+        valid = self.valid[i]
+        j = np.flatnonzero(valid)
+        if len(j) == 0 or valid[j[0]:j[-1]+1].all():
+            index = slice(j[0], j[-1]+1) if len(j) else slice(0, 0)
+        else:
+            index = j
+        columns = {'date': self.dates[index]}
+        for field, m in self.fields.items():
+            columns[field] = m[i, index]
+        return columns
+
+    def frame(self, code):
+        '''
+        The valid bars of a code as the DataFrame dict2dataframe makes,
+        with float32 prices.
+        '''
+        columns = self.view(code)
+        index = pd.DatetimeIndex(columns['date'].astype('datetime64[ns]'))
+        return pd.DataFrame({field: columns[field] for field, dtype in store.FIELDS[1:]},
+                            index=index, copy=False)
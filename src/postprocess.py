@@ -5,30 +5,39 @@
 
 # --- IMPORT ---
 import os
+import gc
 import sys
-import json
 import datetime
 import xlsxwriter
 import argparse
 import textwrap
+import functools
+import collections
+import multiprocessing
 from dateutil.relativedelta import relativedelta
 import numpy as np
 import pandas as pd
 from xlsxwriter.workbook import Workbook
 import config
 import calc
+import indicators
 import visualize
 import extract
+import panel
+import store
+import metrics
+import build
 
 
 # In[2]:
 
-def calculate_indicators(df, n_short=12, n_long=26, n_signal=9, n_K=5, n_D=3 ,n_D_slow=3):
-    v = df["end_adj"]
-    df["macd"]   = calc.calc_macd(v, n_short, n_long)
-    df["signal"] = calc.calc_signal(v, n_signal, n_short, n_long)
-    df["D"]      = calc.calc_D(v, n_K, n_D)
-    df["D_slow"] = calc.calc_D_slow(v, n_K, n_D, n_D_slow)
+def calculate_indicators(df, n_short=12, n_long=26, n_signal=9, n_K=5, n_D=3 ,n_D_slow=3, **params):
+    # every indicator registered as an output becomes a column,
+    # intermediates shared between them are calculated once
+    pipeline = indicators.Pipeline(df, n_short=n_short, n_long=n_long, n_signal=n_signal,
+                                   n_K=n_K, n_D=n_D, n_D_slow=n_D_slow, **params)
+    for name in indicators.outputs():
+        df[name] = pipeline[name]
     df = np.round(df)
     return df
 
@@ -40,79 +49,297 @@ def identify_promise(df):
     macd   = data_lastday["macd"]
     signal = data_lastday["signal"]
     D_slow = data_lastday["D_slow"]
-    if macd >= 0 and macd > signal and D_slow <= 20:
-        return "BUY"
-    elif macd <= 0 and macd < signal and D_slow >= 80:
-        return "SELL"
-    else:
-        return "STAY"
+    return calc.judge(macd, signal, D_slow)
 
 
 # In[4]:
 
-def insert_df_to_xlsx(df, worksheet):    
-    for c, cell in enumerate(df.reset_index().columns):
-        worksheet.write(0, c, cell)
-    for r, row in df.reset_index().iterrows():
-        for c, cell in enumerate(row):
-            if isinstance(cell, datetime.datetime):
-                cell = str(cell)
-            if isinstance(cell, float):
-                if np.isnan(cell):
-                    cell = None
-            worksheet.write(r+1, c, cell)
+def insert_df_to_xlsx(df, worksheet, date_format=None):
+    # the constant_memory mode only accepts rows in order, so each row is
+    # written at once by write_row instead of column by column.
+    # NaN cells are left blank and dates are real excel dates if a format is given
+    df = df.reset_index()
+    worksheet.write_row(0, 0, list(df.columns))
+    columns = []
+    formats = []
+    for column in df.columns:
+        values = df[column]
+        if np.issubdtype(values.dtype, np.datetime64):
+            if date_format is None:
+                columns.append([str(cell) for cell in values])
+            else:
+                columns.append(list(values.dt.to_pydatetime()))
+            formats.append(date_format)
+        elif np.issubdtype(values.dtype, np.number):
+            columns.append(values.astype(object).where(values.notna(), None).tolist())
+            formats.append(None)
+        else:
+            columns.append(values.tolist())
+            formats.append(None)
+    # consecutive columns of the same format are written by a single call
+    spans = []
+    for c, cell_format in enumerate(formats):
+        if spans and spans[-1][2] is cell_format:
+            spans[-1][1] = c + 1
+        else:
+            spans.append([c, c + 1, cell_format])
+    for r, row in enumerate(zip(*columns)):
+        for first, last, cell_format in spans:
+            worksheet.write_row(r+1, first, row[first:last], cell_format)
 
 
 # In[5]:
 
-def main(start_date, end_date):
-
-    workbook = xlsxwriter.Workbook(config.xlsx_path)
-    prediction = workbook.add_worksheet("予測")
-    counter = 0
+def release_sheet(worksheet):
+    '''
+    Close the temporary file holding the rows of a finished sheet in
+    constant_memory mode, which xlsxwriter otherwise keeps open for every
+    sheet until the workbook is closed, i.e. one per code.
 
-    with open(config.json_path, 'r') as f:
-        data = json.load(f)    
-    
-    for code in config.codes:
-        name = data[code]['name']
-        name_base = code + "_" + name
-        data_focus = extract.extract_data(data, code, start_date, end_date)
-        df = extract.dict2dataframe(data_focus)
-        df = calculate_indicators(df)
+    xlsxwriter has no public call for it. This relies on the private
+    Worksheet._opt_close of xlsxwriter 1.1.8 (pinned) up to 3.2: it only
+    closes the file, which the packager reopens when the workbook is
+    closed before flushing the last row, still buffered in memory.
+    '''
+    worksheet._opt_close()
 
-        os.makedirs(config.c_dir_path, exist_ok=True)
-        os.makedirs(config.m_dir_path, exist_ok=True)
-        os.makedirs(config.s_dir_path, exist_ok=True)        
-        c_path = os.path.join(config.c_dir_path, name_base + ".png")
-        m_path = os.path.join(config.m_dir_path, name_base + ".png")
-        s_path = os.path.join(config.s_dir_path, name_base + ".png")
 
-        visualize.draw_candlestick(df, c_path)
-        visualize.draw_indicators(df, ["macd", "signal"], m_path)
-        visualize.draw_indicators(df, ["D",    "D_slow"], s_path)
+class WorkbookWriter(object):
+    '''
+    Write the sheet of each code and the prediction sheet into an excel file
+    in constant memory: rows of a sheet are flushed to disk as they are written.
+    '''
 
-        worksheet = workbook.add_worksheet(name_base[:30])
+    def __init__(self, path):
+        self.path = path
+        self.workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        self.prediction = self.workbook.add_worksheet("予測")
+        self.date_format = self.workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        self.counter = 0
 
-        promise = identify_promise(df)
+    def add(self, name_base, df, promise, paths):
+        c_path, m_path, s_path = paths
+        worksheet = self.workbook.add_worksheet(name_base[:30])
 
         if  promise == "BUY":
             worksheet.set_tab_color("red")
-            prediction.write(counter, 0, "BUY")
-            prediction.write(counter, 1, name_base)
-            counter += 1
+            self.prediction.write(self.counter, 0, "BUY")
+            self.prediction.write(self.counter, 1, name_base)
+            self.counter += 1
         elif promise == "SELL":
             worksheet.set_tab_color("blue")
-            prediction.write(counter, 0, "SELL")
-            prediction.write(counter, 1, name_base)
-            counter += 1
-        insert_df_to_xlsx(df, worksheet)
+            self.prediction.write(self.counter, 0, "SELL")
+            self.prediction.write(self.counter, 1, name_base)
+            self.counter += 1
+        insert_df_to_xlsx(df, worksheet, self.date_format)
         worksheet.insert_image('N1',  c_path, {'x_scale': 0.5, 'y_scale': 0.5})
         worksheet.insert_image('N21', m_path, {'x_scale': 0.5, 'y_scale': 0.5})
         worksheet.insert_image('N41', s_path, {'x_scale': 0.5, 'y_scale': 0.5})
+        release_sheet(worksheet)
+
+    def close(self):
+        self.workbook.close()
+        print("an excel written in", self.path)
+
+
+class FileWriter(object):
+    '''
+    Write the table of each code into a csv or npz file named after the code
+    and the BUY/SELL predictions into prediction.csv, for consumers without excel.
+    '''
+
+    def __init__(self, dir_path, file_format):
+        self.dir_path = dir_path
+        self.file_format = file_format
+        self.predictions = []
+        os.makedirs(dir_path, exist_ok=True)
+
+    def add(self, name_base, df, promise, paths):
+        path = os.path.join(self.dir_path, name_base + "." + self.file_format)
+        if self.file_format == "csv":
+            df.to_csv(path, index_label="date")
+        else:
+            columns = {column: df[column].values for column in df.columns}
+            np.savez(path, date=df.index.values.astype("datetime64[D]"), **columns)
+        if promise != "STAY":
+            self.predictions.append((promise, name_base))
+
+    def close(self):
+        path = os.path.join(self.dir_path, "prediction.csv")
+        pd.DataFrame(self.predictions, columns=["promise", "code"]).to_csv(path, index=False)
+        print("files written in", self.dir_path)
+
+
+# In[6]:
+
+def resident_mb():
+    '''
+    Return the current, not the peak, resident memory of this process in MiB,
+    or None if it cannot be measured: outside Linux it needs psutil.
+    '''
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2**20
+
+
+class MemoryCeiling(object):
+    '''
+    Keep the resident memory of a process under `limit` MiB between codes.
+    Over the limit, garbage is collected and the figures of the charts are
+    released to be created again, and MemoryError is raised if it is still over.
+    A limit of 0 or None disables the check, as does a platform where
+    the resident memory cannot be measured.
+    '''
+
+    def __init__(self, limit=None):
+        if limit and resident_mb() is None:
+            print("warning: the resident memory cannot be measured on {} without psutil,"
+                  " so the ceiling of {} MiB is ignored".format(sys.platform, limit), file=sys.stderr)
+            limit = None
+        self.limit = limit
+
+    def check(self, code):
+        if not self.limit or resident_mb() <= self.limit:
+            return
+        gc.collect()
+        visualize.default_renderer().close()
+        metrics.count("memory_releases")
+        resident = resident_mb()
+        if resident > self.limit:
+            raise MemoryError("{:.0f} MiB resident after {} exceeds the ceiling of {} MiB".format(
+                resident, code, self.limit))
+
+
+def imap_bounded(pool, func, iterable, window):
+    # pool.imap without its unbounded read-ahead: at most `window` results
+    # wait for the consumer, however slowly it writes them
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+_panel = None
+
+def load_panel(codes, start_date, end_date):
+    # loaded before the pool is created, the panel is shared with
+    # the workers, which otherwise load the panel of their code
+    global _panel
+    _panel = panel.Panel.load(store.open_store(), codes, start_date, end_date)
+
+
+def make_materials(code, start_date, end_date, built=None, ceiling=None, charts=True):
+    '''
+    Extract, calculate and draw the materials of the sheet of a code,
+    or reuse those of the last build if its input has not changed.
+
+    Args:
+        built (dict): code -> hash of the input in the last build.
+        ceiling (MemoryCeiling): checked once the code is done.
+        charts (bool): if False, no chart is drawn, e.g. for a csv or npz output.
+    Returns:
+        tuple: the code, the name of the sheet, the indicator frame, the promise,
+            the paths of the charts, or None without charts, and the hash of the input.
+    '''
+    with metrics.stage("extract", code):
+        prices = store.open_store()
+        name_base = code + "_" + prices.name(code)
+        if _panel is not None and _panel.period == (start_date, end_date) and code in _panel.rows:
+            universe = _panel
+        else:
+            universe = panel.Panel.load(prices, [code], start_date, end_date)
+        digest = build.window_hash(name_base, universe.view(code))
+
+    c_path = os.path.join(config.c_dir_path, name_base + ".png")
+    m_path = os.path.join(config.m_dir_path, name_base + ".png")
+    s_path = os.path.join(config.s_dir_path, name_base + ".png")
+    frame_path = os.path.join(config.build_dir_path, "frames", code + ".npz")
+
+    paths = (c_path, m_path, s_path)
+    if built is not None and built.get(code) == digest and os.path.exists(frame_path):
+        with metrics.stage("reuse", code):
+            df = build.load_frame(frame_path)
+        metrics.count("codes_reused")
+    else:
+        with metrics.stage("indicators", code):
+            df = universe.frame(code)
+            df = calculate_indicators(df)
+        # charts of an older input must not be reused with this frame
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        build.save_frame(frame_path, df)
+
+    if charts and not all(map(os.path.exists, paths)):
+        os.makedirs(config.c_dir_path, exist_ok=True)
+        os.makedirs(config.m_dir_path, exist_ok=True)
+        os.makedirs(config.s_dir_path, exist_ok=True)
+        with metrics.stage("render", code):
+            candle = indicators.Pipeline(df, price="end")
+            averages = {12: candle["ema_short"], 26: candle["ema_long"]}
+            visualize.draw_candlestick(df, c_path, averages)
+            visualize.draw_indicators(df, ["macd", "signal"], m_path)
+            visualize.draw_indicators(df, ["D",    "D_slow"], s_path)
+
+    promise = identify_promise(df)
+    if ceiling is not None:
+        ceiling.check(code)
+    return code, name_base, df, promise, paths if charts else None, digest
+
+
+# In[7]:
+
+def main(start_date, end_date, jobs=1, output="xlsx", rebuild=False, stream=False, max_memory=None):
+
+    if output == "xlsx":
+        writer = WorkbookWriter(config.xlsx_path)
+    else:
+        writer = FileWriter(os.path.join(config.res_dir_path, output), output)
+
+    # migrate the database, if needed, before workers read it
+    with metrics.stage("store_open"):
+        store.open_store()
+    if not stream:
+        # streamed, each code loads its own window instead,
+        # so that memory does not grow with the universe
+        with metrics.stage("panel"):
+            load_panel(config.codes, start_date, end_date)
+    ceiling = MemoryCeiling(max_memory)
+    # codes whose input is unchanged since the last build reuse its materials
+    manifest = build.Manifest(os.path.join(config.build_dir_path, "manifest.json"))
+    _make_materials = functools.partial(make_materials, start_date=start_date, end_date=end_date,
+                                        built=None if rebuild else dict(manifest.hashes), ceiling=ceiling,
+                                        charts=output == "xlsx")
+    if jobs > 1:
+        # workers extract, calculate and draw while this process alone
+        # writes the workbook in the order of config.codes
+        pool = multiprocessing.Pool(jobs)
+        materials = metrics.merged(imap_bounded(pool, metrics.collecting(_make_materials), config.codes, 2 * jobs))
+    else:
+        pool = None
+        materials = map(_make_materials, config.codes)
+    
+    for code, name_base, df, promise, paths, digest in materials:
+        with metrics.stage("write", code):
+            writer.add(name_base, df, promise, paths)
+        manifest.hashes[code] = digest
         print("a sheet made for", code)
-    workbook.close()
-    print("an excel written in", config.xlsx_path)
+        del df
+        ceiling.check(code)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    with metrics.stage("write"):
+        writer.close()
+    manifest.save()
 
 if __name__ == '__main__':
     
@@ -128,8 +355,30 @@ if __name__ == '__main__':
                         help='The date from when to extract stock prices. Its format must be YYYY-MM-DD')
     parser.add_argument('-END', default=None,
                         help='The date until when to extract stock prices. Its format must be YYYY-MM-DD')
+    parser.add_argument('-JOBS', default=1, type=int,
+                        help='The number of processes extracting data, calculating indicators and drawing charts')
+    parser.add_argument('-OUTPUT', default='xlsx', choices=['xlsx', 'csv', 'npz'],
+                        help='xlsx makes an excel file. csv and npz make a file per code\n'
+                             'and prediction.csv inside results/csv or results/npz instead.')
+    parser.add_argument('-REBUILD', action='store_true',
+                        help='Calculate and draw every code again instead of reusing\n'
+                             'the indicators and the charts of codes whose data has not changed.')
+    parser.add_argument('-METRICS', action='store_true',
+                        help='Write the time of each stage and code and the peak memory into results/metrics.')
+    parser.add_argument('-PROFILE', nargs='+', default=[], choices=['extract', 'indicators', 'render', 'reuse', 'write'],
+                        help='Run the given stages under cProfile. It implies -METRICS.')
+    parser.add_argument('-STREAM', action='store_true',
+                        help='Load the data of one code at a time instead of the whole universe at once,\n'
+                             'so that memory stays flat however many codes there are.')
+    parser.add_argument('-MAX_MEMORY', default=None, type=float,
+                        help='The resident memory in MiB above which each process releases\n'
+                             'its caches between codes, and stops if it is still above.')
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
                         
     args = parser.parse_args()    
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
                         
     if args.END is None:                
         end_datetime = datetime.datetime.today()                
@@ -144,5 +393,10 @@ if __name__ == '__main__':
     end_date = end_datetime.strftime('%Y-%m-%d')
     start_date = start_datetime.strftime('%Y-%m-%d')    
     
-    main(start_date, end_date)
+    if args.METRICS or args.PROFILE:
+        metrics.enable(args.PROFILE, metrics.profile_dir("postprocess") if args.PROFILE else None)
+    with metrics.stage("total"):
+        main(start_date, end_date, args.JOBS, args.OUTPUT, args.REBUILD, args.STREAM, args.MAX_MEMORY)
+    if metrics.enabled():
+        print("metrics written in", metrics.write_report("postprocess", args=vars(args)))
 
@@ -0,0 +1,114 @@
+import sys
+import json
+import socket
+import argparse
+import textwrap
+import config
+
+# A thin client of server.py. It imports nothing heavier than the standard
+# library so that it starts quickly; only if the server is not running does
+# it import the modules needed to answer the query by itself.
+
+FIELDS = ['date', 'start', 'end', 'low', 'high', 'volumn', 'end_adj', 'div']
+INDICATORS = ['macd', 'signal', 'D', 'D_slow']
+
+
+class QueryError(Exception):
+    pass
+
+
+def request(payload, socket_path=None):
+    '''
+    Send a request to server.py and return the result.
+
+    Raises:
+        OSError: if the server is not running.
+        QueryError: if the server could not answer.
+    '''
+    socket_path = config.socket_path if socket_path is None else socket_path
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            response = json.loads(f.readline())
+    if not response['ok']:
+        raise QueryError(response['error'])
+    return response['result']
+
+
+def answer_locally(payload):
+    import store
+    prices = store.open_store()
+    if payload.get('op') == 'codes':
+        # listing the codes needs no index of their series
+        return prices.codes()
+    import server
+    index = server.PriceIndex(prices, payload.get('codes'))
+    try:
+        return server.answer(index, payload)
+    except Exception as e:
+        raise QueryError('{}: {}'.format(type(e).__name__, e))
+
+
+def print_range(result):
+    for code, data in result.items():
+        if len(result) > 1:
+            print(code, data['name'])
+        print('\t'.join(FIELDS))
+        columns = data['columns']
+        for row in zip(*[columns[field] for field in FIELDS]):
+            print('\t'.join('' if cell is None else str(cell) for cell in row))
+
+
+def print_latest(result):
+    for code, latest in result.items():
+        print(latest['promise'], code, latest['date'],
+              ' '.join('{}={}'.format(k, latest[k]) for k in INDICATORS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Query the stock prices of codes for a period, or their latest indicators,
+                             from server.py. Without a running server the database is read directly.
+                             If -START and -END arguments are not specified,
+                             it queries data from 6 months ago to the day of the query.
+                             """))
+    parser.add_argument('CODE', nargs='*',
+                        help='The stock codes to query. All the stored codes are listed if none')
+    parser.add_argument('-START', default=None,
+                        help='The date from when to query stock prices. Its format must be YYYY-MM-DD')
+    parser.add_argument('-END', default=None,
+                        help='The date until when to query stock prices. Its format must be YYYY-MM-DD')
+    parser.add_argument('-LATEST', action='store_true',
+                        help='Query the indicators on the last day and whether it is BUY, SELL or STAY')
+    parser.add_argument('-JSON', action='store_true',
+                        help='Print the result as JSON')
+    parser.add_argument('-SOCKET', default=config.socket_path,
+                        help='The path of the Unix domain socket of the server')
+
+    args = parser.parse_args()
+    if not args.CODE:
+        payload = {'op': 'codes'}
+    elif args.LATEST:
+        payload = {'op': 'latest', 'codes': args.CODE}
+    else:
+        payload = {'op': 'range', 'codes': args.CODE, 'start': args.START, 'end': args.END}
+
+    try:
+        try:
+            result = request(payload, args.SOCKET)
+        except OSError:
+            result = answer_locally(payload)
+    except QueryError as e:
+        sys.exit(str(e))
+
+    if args.JSON:
+        print(json.dumps(result, ensure_ascii=False))
+    elif payload['op'] == 'codes':
+        print('\n'.join(result))
+    elif payload['op'] == 'latest':
+        print_latest(result)
+    else:
+        print_range(result)
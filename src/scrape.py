@@ -2,27 +2,34 @@ import re
 import os
 import sys
 import bs4
-import json
-import shutil
 import logging
 import datetime
 import requests
+import lxml.html
 import argparse
 import textwrap
 import functools
+import itertools
+import random
+import time
 import multiprocessing
+import numpy as np
 import pandas as pd
 from time import sleep
 from logging import getLogger
 from dateutil import relativedelta
 import config
+import store
+import metrics
+from cache import PageCache
+from journal import Journal
 
 
 logging.basicConfig(level=logging.INFO)
 logger = getLogger(__name__)
 
 
-def specify_url(code, start_date, end_date, page):
+def specify_url(code, start_date, end_date, page, base_url=None):
     '''
     Specify a url from stock code, scraping period, and page index.
     
@@ -33,18 +40,23 @@ def specify_url(code, start_date, end_date, page):
         end_date (str): a string specifying the end date for scraping.
             its format must be 'YYYY-MM-DD'.
         page (str or int): a page index.
+        base_url (str): the url of the history site.
+            config.history_url is used if None.
     Returns:
         str: a valid url.
     '''
+    if base_url is None:
+        base_url = config.history_url
     start_datetime = datetime.datetime.strptime(start_date, "%Y-%m-%d")
     end_datetime = datetime.datetime.strptime(end_date, "%Y-%m-%d")    
     
     url = '''
-    https://info.finance.yahoo.co.jp/history/?code={code}\
+    {base_url}?code={code}\
     &sy={start_year}&sm={start_month:0>2}&sd={start_day:0>2}\
     &ey={end_year}&em={end_month:0>2}&ed={end_day:0>2}\
     &tm=d&p={page}
     '''.strip().replace(' ', '').format(
+        base_url=base_url,
         code=code,
         start_year=start_datetime.year,
         start_month=start_datetime.month,
@@ -57,13 +69,92 @@ def specify_url(code, start_date, end_date, page):
     return url
 
 
-def extract_soup(url):
+def request(url, timeout=None):
     
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) \
     AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
-    response = requests.get(url, headers=headers)
-    soup = bs4.BeautifulSoup(response.text, "lxml")
+    t = time.perf_counter()
+    response = requests.get(url, headers=headers, timeout=timeout)
+    metrics.observe('request_latency', time.perf_counter() - t)
+    metrics.count('pages_fetched')
+    metrics.count('bytes_downloaded', len(response.content))
+    
+    return response
+
+
+def extract_html(url):
+    
+    response = request(url)
+    
+    return response.text
+
+
+class Retry(object):
+    '''
+    How failed requests are retried: at most `retries` times, waiting
+    `backoff` seconds doubled at each retry up to `max_backoff`, plus
+    up to 10% of jitter. Each request times out after `timeout` seconds.
+    '''
+
+    def __init__(self, retries=4, backoff=1., max_backoff=30., timeout=30.):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * (1 + 0.1 * random.random())
+
+
+def is_retryable(e):
+    # a page without the table of prices is what a throttled request gets
+    if isinstance(e, requests.HTTPError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, (requests.RequestException, ValueError))
+
+
+def fetch_page(url, code=None, cache=None, retry=None):
+    '''
+    Fetch and parse a page, retrying on timeouts, connection errors,
+    server errors, throttling and pages which cannot be parsed.
+    A page is cached only once it has been parsed.
+    
+    Returns:
+        tuple: the columns, the company name and whether a next page exists.
+    '''
+    retry = Retry() if retry is None else retry
+    use_cache = cache is not None
+    for attempt in itertools.count():
+        html = cache.get(url) if use_cache else None
+        from_cache = html is not None
+        try:
+            if from_cache:
+                metrics.count('cache_hits')
+            else:
+                with metrics.stage('fetch', code):
+                    response = request(url, retry.timeout)
+                    response.raise_for_status()
+                    html = response.text
+            parsed = parse_page(html, code)
+        except Exception as e:
+            if attempt >= retry.retries or not is_retryable(e) or (from_cache and cache.offline):
+                raise
+            # a broken cached page is fetched again
+            use_cache = cache is not None and not from_cache
+            delay = retry.delay(attempt)
+            metrics.count('retries')
+            logger.warning('retrying {} in {:.1f}s after {}: {}'.format(url, delay, type(e).__name__, e))
+            sleep(delay)
+            continue
+        if cache is not None and not from_cache:
+            cache.put(url, html)
+        return parsed
+
+
+def extract_soup(url):
+    
+    soup = bs4.BeautifulSoup(extract_html(url), "lxml")
     
     return soup
 
@@ -88,7 +179,7 @@ def extract_dataframe(soup):
     divs = df['start'].str.startswith('分割')
     df = df[~divs]
     df['div'] = 0
-    df.loc[df.index[pd.np.where(divs)[0]], 'div'] = 1
+    df.loc[df.index[np.where(divs)[0]], 'div'] = 1
     
     return df
 
@@ -96,6 +187,12 @@ def extract_dataframe(soup):
 def extract_company(soup):
     
     string = soup.find(name="th", attrs={"class":"symbol"}).string
+    
+    return clean_company(string)
+
+
+def clean_company(string):
+    
     string = re.sub(r"[\(\（][\w\W]*[\)\）]", r"", string)
     string = re.sub(r",", r"", string)
     string = re.sub(r"\n", r"", string)
@@ -106,83 +203,212 @@ def extract_company(soup):
     return string
 
 
-def scrape(code, start_date, end_date, dir_path, sleeptime):
+DATE_PATTERN = re.compile(r"(\d+)年(\d+)月(\d+)日")
+
+
+def parse_history(html):
+    '''
+    Parse a history page with lxml in a single pass.
+    It is equivalent to extract_dataframe, extract_company and 
+    the search for the link to the next page, but much faster.
+    
+    Args:
+        html (str or bytes): a history page.
+    Returns:
+        dict: column name -> typed 1-D array in the order of the page,
+            with the same columns as store.FIELDS.
+        str: the company name.
+        bool: whether the page links to a next page.
+    '''
+    tree = lxml.html.fromstring(html)
+    tables = tree.xpath('//table[contains(concat(" ", normalize-space(@class), " "), " boardFin ")]')
+    if not tables:
+        raise ValueError('no boardFin table found in the page')
+    dates = []
+    values = []
+    divs = []
+    for row in tables[0].iter('tr'):
+        cells = [cell.text_content().replace(",", "") for cell in row if cell.tag in ('td', 'th')]
+        match = DATE_PATTERN.match(cells[0]) if cells else None
+        if match is None:
+            continue # header
+        if len(cells) < 7 or cells[1].startswith('分割'):
+            # deal with stock division in the same way as extract_dataframe
+            divs.append(len(dates) + len(divs))
+            continue
+        dates.append('{:0>4}-{:0>2}-{:0>2}'.format(*match.groups()))
+        values.append(cells[1:7])
+    columns = {'date': np.array(dates, dtype=store.DTYPES['date'])}
+    values = np.array(values, dtype='float64').reshape(-1, 6)
+    for i, field in enumerate(['start', 'end', 'low', 'high', 'volumn', 'end_adj']):
+        columns[field] = values[:, i].astype(store.DTYPES[field])
+    columns['div'] = np.zeros(len(dates), dtype=store.DTYPES['div'])
+    columns['div'][[i for i in divs if i < len(dates)]] = 1
+    
+    symbols = tree.xpath('//th[contains(concat(" ", normalize-space(@class), " "), " symbol ")]')
+    company = clean_company(symbols[0].text_content()) if symbols else ''
+    next_found = bool(tree.xpath('//a[.="次へ"]'))
+    
+    return columns, company, next_found
+
+
+def parse_page(html, code=None):
+    
+    with metrics.stage('parse', code):
+        return parse_history(html)
+
+
+def concat_columns(pages):
+    
+    return {field: np.concatenate([page[field] for page in pages]) for field, dtype in store.FIELDS}
+
+
+def scrape(code, start_date, end_date, sleeptime, base_url=None, cache=None, retry=None, journal=None,
+           on_page=None):
+    '''
+    Scrape every page of a code over a period.
+    `on_page`, if given, is called with the code and the page after each page.
+    '''
 
     page = 1
-    df = pd.DataFrame()
+    pages = []
     next_found = True
     while next_found:
-        logger.info("code: {}, page: {}".format(code, page))
-        url = specify_url(code, start_date, end_date, page)
-        soup = extract_soup(url)
-        _df = extract_dataframe(soup)
-        df = pd.concat([df, _df], ignore_index=True)
-        next_found = soup.find(name="a", text="次へ")
+        saved = journal.load_page(code, page) if journal is not None else None
+        if saved is not None:
+            columns, company, next_found = saved
+        else:
+            logger.info("code: {}, page: {}".format(code, page))
+            url = specify_url(code, start_date, end_date, page, base_url)
+            columns, company, next_found = fetch_page(url, code, cache, retry)
+            if journal is not None:
+                journal.save_page(code, page, columns, company, next_found)
+            sleep(sleeptime)
+        pages.append(columns)
+        if on_page is not None:
+            on_page(code, page)
         page += 1
-        sleep(sleeptime)
-    company = extract_company(soup)
-    os.makedirs(dir_path, exist_ok=True)
-    file_name = '{}_{}.csv'.format(code, company)
-    file_path = os.path.join(dir_path, file_name)
-    df.to_csv(file_path, index=False)
-    logger.info('file saved to {}'.format(file_path))
+    
+    return company, concat_columns(pages)
 
 
-def collect_new_data(dir_path):
+def scrape_job(job, end_date, sleeptime, base_url=None, cache=None, retry=None, journal=None):
+    '''
+    Scrape a (code, start date) job in a worker of the process pool.
+    A failure is logged and reported as None instead of being raised
+    so that it does not abort the jobs of the other codes.
     
-    new_data = {}
-    file_names = os.listdir(dir_path)
-    for file_name in file_names:
-        file_path = os.path.join(dir_path, file_name)
-        code, company = file_name.strip('.csv').split('_')
-        new_data[code] = {'name': company}
-        df = pd.read_csv(file_path)
-        data = df.set_index('date').to_dict(orient='index')
-        new_data[code]['data'] = data
-            
-    return new_data
+    Returns:
+        tuple: the code, the company name and the columns of the period.
+    '''
+    code, start_date = job
+    try:
+        company, columns = scrape(code, start_date, end_date, sleeptime, base_url, cache, retry, journal)
+    except Exception:
+        logger.exception('failed to scrape {}'.format(code))
+        return code, None, None
+    
+    return code, company, columns
+
+
+def specify_start_dates(prices, codes, start_date, end_date):
+    '''
+    Specify the date from when to scrape each code so that only days
+    missing in the database are requested. A stored code is scraped from
+    the day after its last bar even if that precedes `start_date`,
+    so that no hole is left in its series.
+    
+    Args:
+        prices (store.PriceStore): the database.
+        codes (list of str): stock codes.
+        start_date (str): the date from when to scrape codes not stored yet
+            formatted as 'YYYY-MM-DD'.
+        end_date (str): the end date for scraping formatted as 'YYYY-MM-DD'.
+    Returns:
+        dict: code -> start date formatted as 'YYYY-MM-DD'.
+            Codes already stored up to the last weekday until `end_date` are omitted.
+    '''
+    start_dates = {}
+    for code in codes:
+        last = prices.last_date(code) if code in prices else None
+        if last is None:
+            start_dates[code] = start_date
+            continue
+        first_missing = last + np.timedelta64(1, 'D')
+        if np.busday_count(first_missing, np.datetime64(end_date) + np.timedelta64(1, 'D')) > 0:
+            start_dates[code] = str(first_missing)
+            if start_dates[code] < start_date:
+                logger.info('{} was last stored on {} and is scraped from then on'.format(code, last))
+    return start_dates
 
 
-def main(start_date, end_date, months, sleeptime):
+def main(start_date, end_date, months, sleeptime,
+         asynchronous=False, concurrency=8, latency=2., rate=10., parsers=2, url=None,
+         incremental=False, cache=None, retry=None, resume=True, fresh=False):
     
     if end_date is None:
         end_datetime = datetime.datetime.today()
     else:
-        end_datetime = datetime.datetime.strptime(end, "%Y-%m-%d")
+        end_datetime = datetime.datetime.strptime(end_date, "%Y-%m-%d")
         
     if start_date is None:
         start_datetime = end_datetime - relativedelta.relativedelta(months=months)
     else:
-        start_datetime = datetime.datetime.strptime(start, "%Y-%m-%d")
+        start_datetime = datetime.datetime.strptime(start_date, "%Y-%m-%d")
         
     start_date = start_datetime.strftime("%Y-%m-%d")
     end_date = end_datetime.strftime("%Y-%m-%d")
     
-    data = {}
-    if os.path.exists(config.json_path):
-        logger.info('loading existing database from {}'.format(config.json_path))
-        with open(config.json_path, "r") as f:
-            data = json.load(f)
-        
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-        dir_path = os.path.join(os.path.dirname(config.json_path), 'tmp')
-        if os.path.exists(dir_path):
-            shutil.rmtree(dir_path)
-        os.mkdir(dir_path)
-        logger.info('scraping new data in parallel and save them in {}'.format(dir_path))
-        _scrape = functools.partial(
-            scrape, start_date=start_date, end_date=end_date, 
-            dir_path=dir_path, sleeptime=sleeptime)
-        results = p.map(_scrape, config.codes)
+    with metrics.stage('store_open'):
+        prices = store.open_store()
+    failed = []
+    
+    def save(code, company, columns):
+        # the only writer of the database, called as each code is done
+        if columns is None:
+            failed.append(code)
+            return
+        with metrics.stage('store', code):
+            prices.merge(code, company, columns)
+        if journal is not None:
+            journal.mark_done(code, len(columns['date']))
+        logger.info('{} rows of {} saved to {}'.format(len(columns['date']), code, prices.root))
+    
+    if incremental:
+        start_dates = specify_start_dates(prices, config.codes, start_date, end_date)
+        logger.info('{} codes are up to date and skipped'.format(len(config.codes) - len(start_dates)))
+    else:
+        start_dates = {code: start_date for code in config.codes}
+    
+    journal = Journal(config.journal_dir_path, start_date, end_date, url, fresh) if resume else None
+    if journal is not None:
+        done = journal.done_codes()
+        if done:
+            logger.info('resuming an interrupted run: {} codes already saved are skipped'.format(len(done)))
+        start_dates = {code: date for code, date in start_dates.items() if code not in done}
         
-    logger.info('collecting new data from {}'.format(dir_path))
-    new_data = collect_new_data(dir_path)
-    data.update(new_data)
-
-    logger.info('saving updated database to {}'.format(config.json_path))
-    with open(config.json_path, "w") as f:
-        json.dump(data, f, indent=1)
+    if asynchronous:
+        import aioscrape
+        logger.info('scraping new data asynchronously with {} connections'.format(concurrency))
+        aioscrape.run(
+            list(start_dates), start_date, end_date, save, concurrency=concurrency, latency=latency,
+            rate=rate, n_parsers=parsers, base_url=url, start_dates=start_dates, cache=cache,
+            retry=retry, journal=journal)
+    else:
+        with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
+            logger.info('scraping new data in parallel')
+            _scrape_job = functools.partial(
+                scrape_job, end_date=end_date, 
+                sleeptime=sleeptime, base_url=url, cache=cache, retry=retry, journal=journal)
+            for result in metrics.merged(p.imap_unordered(metrics.collecting(_scrape_job), start_dates.items())):
+                save(*result)
 
+    if failed:
+        logger.warning('failed to scrape {} codes: {}'.format(len(failed), ', '.join(sorted(failed))))
+        if journal is not None:
+            logger.warning('run the same command again to retry them')
+    elif journal is not None:
+        journal.clear()
     logger.info('done.')
 
 
@@ -202,6 +428,62 @@ if __name__ == '__main__':
                         help='The number of months the start date precedes prior to the end date')
     parser.add_argument('-SLEEP', default=0.01, type=float,
                         help='The sleep time between each retrieval.')
+    parser.add_argument('-ASYNC', action='store_true',
+                        help='Retrieve pages asynchronously over pooled connections instead of a process pool.')
+    parser.add_argument('-CONCURRENCY', default=8, type=int,
+                        help='The maximum number of requests in flight with -ASYNC.\n'
+                             'The number actually in flight adapts to the site only with -ASYNC;\n'
+                             'without it each process of the pool sends one request at a time.')
+    parser.add_argument('-LATENCY', default=2., type=float,
+                        help='The seconds above which an answer lowers the requests in flight with -ASYNC.')
+    parser.add_argument('-RATE', default=10., type=float,
+                        help='The maximum number of requests per second to a host with -ASYNC. 0 means no limit.')
+    parser.add_argument('-PARSERS', default=2, type=int,
+                        help='The number of processes parsing pages with -ASYNC.')
+    parser.add_argument('-URL', default=config.history_url,
+                        help='The url of the history site, e.g. that of standin.py for testing.')
+    parser.add_argument('-INCREMENTAL', action='store_true',
+                        help='Retrieve only the days after the last date stored for each code\n'
+                             'and skip codes which are up to date.')
+    parser.add_argument('-TTL', default=600., type=float,
+                        help='The seconds for which a cached page covering today is reused.\n'
+                             'Cached pages of past periods are always reused.')
+    parser.add_argument('-NOCACHE', action='store_true',
+                        help='Neither read nor write the page cache.')
+    parser.add_argument('-OFFLINE', action='store_true',
+                        help='Serve pages only from the cache without accessing the network.')
+    parser.add_argument('-RETRIES', default=4, type=int,
+                        help='The number of times a failed or throttled request is retried.')
+    parser.add_argument('-BACKOFF', default=1., type=float,
+                        help='The seconds before the first retry, doubled at each retry up to 30 seconds.')
+    parser.add_argument('-TIMEOUT', default=30., type=float,
+                        help='The seconds after which a request times out.')
+    parser.add_argument('-FRESH', action='store_true',
+                        help='Discard the progress of an interrupted run of the same period instead of resuming it.')
+    parser.add_argument('-NOJOURNAL', action='store_true',
+                        help='Neither resume an interrupted run nor record the progress of this one.')
+    parser.add_argument('-METRICS', action='store_true',
+                        help='Write the time of each stage and code, the pages and bytes fetched,\n'
+                             'the latencies of requests and the peak memory into results/metrics.')
+    parser.add_argument('-PROFILE', nargs='+', default=[], choices=['fetch', 'parse', 'store'],
+                        help='Run the given stages under cProfile. It implies -METRICS.\n'
+                             'With -ASYNC, fetch profiles the whole event loop and only\n'
+                             'the wall time of fetching is measured, since coroutines interleave.')
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
 
     args = parser.parse_args()
-    main(args.START, args.END, args.MONTH, args.SLEEP)
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
+    if args.NOCACHE and args.OFFLINE:
+        parser.error('-OFFLINE needs the page cache')
+    cache = None if args.NOCACHE else PageCache(config.cache_dir_path, args.TTL, args.OFFLINE)
+    if args.METRICS or args.PROFILE:
+        metrics.enable(args.PROFILE, metrics.profile_dir('scrape') if args.PROFILE else None)
+    with metrics.stage('total'):
+        main(args.START, args.END, args.MONTH, args.SLEEP,
+             args.ASYNC, args.CONCURRENCY, args.LATENCY, args.RATE, args.PARSERS, args.URL,
+             args.INCREMENTAL, cache, Retry(args.RETRIES, args.BACKOFF, timeout=args.TIMEOUT),
+             not args.NOJOURNAL, args.FRESH)
+    if metrics.enabled():
+        logger.info('metrics written in {}'.format(metrics.write_report('scrape', args=vars(args))))
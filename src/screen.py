@@ -0,0 +1,173 @@
+import datetime
+import argparse
+import textwrap
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+import config
+import calc
+import panel
+import store
+
+# The rule of postprocess.identify_promise evaluated for every code on
+# every date of a (codes x dates) panel at once, and a backtest of it.
+# Indicators of a code run over its own bars as they do in postprocess:
+# the dates on which it has no bar are skipped, not treated as gaps.
+# They start from the first date of the panel instead of the first date
+# of a report period, which only matters for the first few months.
+
+
+def compact(m):
+    '''
+    Move the valid values of every row of a panel to the left in order.
+
+    Returns:
+        np.ndarray: the compacted panel, NaN-padded on the right.
+        np.ndarray: the column each compacted value comes from.
+    '''
+    valid = ~np.isnan(m)
+    order = np.argsort(~valid, axis=1, kind='stable')
+    return np.take_along_axis(m, order, axis=1), order
+
+
+def expand(m_compact, order, valid):
+    '''
+    Put back values calculated on a compacted panel where they came from.
+    '''
+    m = np.full(m_compact.shape, np.nan, dtype=m_compact.dtype)
+    np.put_along_axis(m, order, m_compact, axis=1)
+    m[~valid] = np.nan
+    return m
+
+
+def screen_panel(m, low=20, high=80, **params):
+    '''
+    Args:
+        m (np.ndarray): a 2-D array of prices whose rows are codes and
+            whose columns are dates, NaN where a code has no bar.
+        low (float): slow D at most which a rising MACD is a BUY.
+        high (float): slow D at least which a falling MACD is a SELL.
+        params: n_short, n_long, n_signal, n_K, n_D and n_D_slow of calc.calc_batch.
+    Returns:
+        dict: boolean arrays 'buy' and 'sell' and the indicators, rounded
+            as postprocess.calculate_indicators does, with the shape of `m`.
+    '''
+    valid = ~np.isnan(m)
+    m_compact, order = compact(m)
+    result = {k: expand(np.round(v), order, valid)
+              for k, v in calc.calc_batch(m_compact, **params).items()}
+    result['buy'], result['sell'] = calc.judge_batch(result['macd'], result['signal'], result['D_slow'], low, high)
+    return result
+
+
+def forward_returns(m, horizon):
+    '''
+    The return from each bar of a code to its bar `horizon` bars later,
+    NaN where there is no such bar.
+    '''
+    valid = ~np.isnan(m)
+    m_compact, order = compact(m)
+    m_return = np.full(m_compact.shape, np.nan)
+    if horizon < m_compact.shape[1]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m_return[:, :-horizon] = m_compact[:, horizon:] / m_compact[:, :-horizon] - 1
+    return expand(m_return, order, valid)
+
+
+def backtest(codes, m, horizon=5, low=20, high=80, result=None, **params):
+    '''
+    Hold a code for `horizon` bars after every BUY and short it after every SELL.
+
+    Args:
+        result (dict): the signals of screen_panel for the same panel and
+            parameters, if already calculated.
+    Returns:
+        pd.DataFrame: per code and for all the codes, the number of signals
+            whose outcome is known, their hit rate and their mean return.
+    '''
+    if result is None:
+        result = screen_panel(m, low, high, **params)
+    m_return = forward_returns(m, horizon)
+    known = ~np.isnan(m_return)
+    rows = {}
+    for side, sign in [('buy', 1), ('sell', -1)]:
+        signals = result[side] & known
+        pnl = np.where(signals, sign * m_return, 0.)
+        n = signals.sum(axis=1)
+        n_hit = (signals & (pnl > 0)).sum(axis=1)
+        total = pnl.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rows['n_' + side] = np.append(n, n.sum())
+            rows[side + '_hit_rate'] = np.append(n_hit, n_hit.sum()) / rows['n_' + side]
+            rows[side + '_return'] = np.append(total, total.sum()) / rows['n_' + side]
+    return pd.DataFrame(rows, index=list(codes) + ['all'])
+
+
+def main(start_date, end_date, horizon=5, low=20, high=80, **params):
+    prices = store.open_store()
+    codes = [code for code in config.codes if code in prices]
+    universe = panel.Panel.load(prices, codes, start_date, end_date)
+    dates, m = universe.dates, universe.matrix('end_adj')
+    result = screen_panel(m, low, high, **params)
+    for i, code in enumerate(codes):
+        valid = np.flatnonzero(~np.isnan(m[i]))
+        if len(valid) == 0:
+            continue
+        if result['buy'][i, valid[-1]]:
+            print("BUY", code, dates[valid[-1]])
+        elif result['sell'][i, valid[-1]]:
+            print("SELL", code, dates[valid[-1]])
+    with pd.option_context('display.max_rows', None):
+        print(backtest(codes, m, horizon, low, high, result, **params))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Judge every code on its last day as postprocess does
+                             and backtest the rule on every day of the period:
+                             hit rates and mean returns -HORIZON bars after
+                             each BUY (held) and each SELL (shorted).
+                             If -START and -END arguments are not specified,
+                             it covers the 2 years up to the day of screening.
+                             """))
+    parser.add_argument('-START', default=None,
+                        help='The date from when to screen. Its format must be YYYY-MM-DD')
+    parser.add_argument('-END', default=None,
+                        help='The date until when to screen. Its format must be YYYY-MM-DD')
+    parser.add_argument('-HORIZON', default=5, type=int,
+                        help='The number of bars a position is held for')
+    parser.add_argument('-LOW', default=20, type=float,
+                        help='Slow D at most which a rising MACD is a BUY')
+    parser.add_argument('-HIGH', default=80, type=float,
+                        help='Slow D at least which a falling MACD is a SELL')
+    parser.add_argument('-SHORT', default=12, type=int,
+                        help='The days of the short exponential average of MACD')
+    parser.add_argument('-LONG', default=26, type=int,
+                        help='The days of the long exponential average of MACD')
+    parser.add_argument('-SIGNAL', default=9, type=int,
+                        help='The days of the exponential average of MACD making the signal')
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
+
+    args = parser.parse_args()
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
+
+    if args.END is None:
+        end_datetime = datetime.datetime.today()
+    else:
+        end_datetime = datetime.datetime.strptime(args.END, '%Y-%m-%d')
+
+    if args.START is None:
+        start_datetime = end_datetime - relativedelta(years=2)
+    else:
+        start_datetime = datetime.datetime.strptime(args.START, '%Y-%m-%d')
+
+    end_date = end_datetime.strftime('%Y-%m-%d')
+    start_date = start_datetime.strftime('%Y-%m-%d')
+
+    main(start_date, end_date, args.HORIZON, args.LOW, args.HIGH,
+         n_short=args.SHORT, n_long=args.LONG, n_signal=args.SIGNAL)
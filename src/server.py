@@ -0,0 +1,211 @@
+import os
+import json
+import datetime
+import threading
+import socketserver
+import argparse
+import textwrap
+import logging
+from logging import getLogger
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import config
+import store
+import stream
+
+
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+
+class PriceIndex(object):
+    '''
+    The whole database held in memory, code by code, with the latest
+    indicators of each code calculated on demand and kept until the
+    code is updated. `refresh` reloads the codes written since the last call.
+    Only `codes` are held if given.
+    '''
+
+    def __init__(self, prices, codes=None):
+        self.prices = prices
+        self.only = None if codes is None else set(str(code) for code in codes)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Returns:
+            list of str: the codes loaded or reloaded.
+        '''
+        reloaded = []
+        codes = [code for code in self.prices.codes() if self.only is None or code in self.only]
+        for code in codes:
+            try:
+                version = self.prices.version(code)
+                entry = self.entries.get(code)
+                if entry is not None and entry['version'] == version:
+                    continue
+                entry = {'version': version, 'name': self.prices.name(code),
+                         'columns': self.prices.read(code, mmap=False), 'latest': None}
+            except (OSError, ValueError):
+                # being written, it is loaded on the next refresh
+                continue
+            with self.lock:
+                self.entries[code] = entry
+            reloaded.append(code)
+        with self.lock:
+            for code in set(self.entries) - set(codes):
+                del self.entries[code]
+        return reloaded
+
+    def codes(self):
+        return sorted(self.entries)
+
+    def range(self, codes, start_date, end_date):
+        '''
+        Returns:
+            dict: code -> {'name': company name, 'columns': column name -> list}
+                of the bars from `start_date` to `end_date`.
+        '''
+        d1 = np.datetime64(start_date, 'D')
+        d2 = np.datetime64(end_date, 'D')
+        result = {}
+        for code in codes:
+            entry = self.entries[code]
+            columns = entry['columns']
+            i1 = np.searchsorted(columns['date'], d1, side='left')
+            i2 = np.searchsorted(columns['date'], d2, side='right')
+            result[code] = {'name': entry['name'],
+                            'columns': {field: _to_list(v[i1:i2]) for field, v in columns.items()}}
+        return result
+
+    def latest(self, codes):
+        '''
+        Returns:
+            dict: code -> the indicators on the last day of the code
+                and whether it is "BUY", "SELL" or "STAY", as stream.py prints.
+        '''
+        result = {}
+        for code in codes:
+            entry = self.entries[code]
+            if entry['latest'] is None:
+                columns = entry['columns']
+                valid = ~np.isnan(columns['end_adj']) # deal with stock division
+                indicators = stream.Indicators()
+                indicators.warm_up(columns['end_adj'][valid], columns['date'][valid])
+                latest = {k: (None if np.isnan(v) else float(v)) for k, v in indicators.last.items()}
+                latest['date'] = indicators.date
+                latest['promise'] = indicators.promise()
+                entry['latest'] = latest
+            result[code] = entry['latest']
+        return result
+
+
+def _to_list(v):
+    if np.issubdtype(v.dtype, np.datetime64):
+        return [str(d) for d in v]
+    if np.issubdtype(v.dtype, np.floating):
+        return [None if np.isnan(x) else x for x in v.tolist()]
+    return v.tolist()
+
+
+def default_period(start_date, end_date):
+    # the same default period as extract.py
+    if end_date is None:
+        end_datetime = datetime.datetime.today()
+    else:
+        end_datetime = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    if start_date is None:
+        start_datetime = end_datetime - relativedelta(months=6)
+    else:
+        start_datetime = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    return start_datetime.strftime('%Y-%m-%d'), end_datetime.strftime('%Y-%m-%d')
+
+
+def answer(index, request):
+    '''
+    Answer a request {"op": ..., ...} with a JSON serializable result.
+    '''
+    op = request.get('op')
+    if op == 'ping':
+        return 'pong'
+    if op == 'codes':
+        return index.codes()
+    codes = [str(code) for code in request.get('codes', [])]
+    missing = [code for code in codes if code not in index.entries]
+    if missing:
+        raise KeyError('unknown codes: {}'.format(', '.join(missing)))
+    if op == 'range':
+        start_date, end_date = default_period(request.get('start'), request.get('end'))
+        return index.range(codes, start_date, end_date)
+    if op == 'latest':
+        return index.latest(codes)
+    raise ValueError('unknown op: {}'.format(op))
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    '''
+    One JSON request per line, answered by one JSON line
+    {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+    '''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'ok': True, 'result': answer(self.server.index, json.loads(line))}
+            except Exception as e:
+                response = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def poll(index, interval, stopped):
+    while not stopped.wait(interval):
+        reloaded = index.refresh()
+        if reloaded:
+            logger.info('{} codes reloaded'.format(len(reloaded)))
+
+
+def serve(socket_path, prices, interval=1.):
+    '''
+    Answer queries on a Unix domain socket until interrupted,
+    reloading the codes updated in the database every `interval` seconds.
+    '''
+    index = PriceIndex(prices)
+    logger.info('{} codes loaded'.format(len(index.entries)))
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    stopped = threading.Event()
+    poller = threading.Thread(target=poll, args=(index, interval, stopped), daemon=True)
+    poller.start()
+    with QueryServer(socket_path, QueryHandler) as server:
+        server.index = index
+        logger.info('serving on {}'.format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stopped.set()
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Hold the database in memory and answer the queries of query.py
+                             on a Unix domain socket, reloading the codes updated by scrape.py.
+                             """))
+    parser.add_argument('-SOCKET', default=config.socket_path,
+                        help='The path of the Unix domain socket')
+    parser.add_argument('-POLL', default=1., type=float,
+                        help='The seconds between checks for updates of the database')
+
+    args = parser.parse_args()
+    serve(args.SOCKET, store.open_store(), args.POLL)
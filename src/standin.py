@@ -0,0 +1,80 @@
+import os
+import argparse
+import textwrap
+import threading
+import urllib.parse
+import http.server
+import config
+
+
+class HistoryHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serve canned history pages named `{code}_{page}.html`
+    from the page directory of the server, with keep-alive.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        code = query.get('code', [''])[0]
+        page = query.get('p', ['1'])[0]
+        path = os.path.join(self.server.page_dir, '{}_{}.html'.format(code, page))
+        self.server.n_requests += 1
+        if not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(page_dir, host='127.0.0.1', port=0):
+    '''
+    Start a stand-in of the history site in a background thread.
+
+    Args:
+        page_dir (str): a directory of canned history pages.
+        host (str): an address to bind.
+        port (int): a port to bind. 0 picks a free one.
+    Returns:
+        http.server.ThreadingHTTPServer: a running server. Its `url` attribute
+            can be passed wherever the url of the history site is expected,
+            and it is stopped by `shutdown()`.
+    '''
+    server = http.server.ThreadingHTTPServer((host, port), HistoryHandler)
+    server.daemon_threads = True
+    server.page_dir = page_dir
+    server.n_requests = 0
+    server.url = 'http://{}:{}/history/'.format(*server.server_address[:2])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Serve canned history pages in place of the history site,
+                             e.g. for `python scrape.py -URL http://127.0.0.1:8000/history/`.
+                             """))
+    parser.add_argument('-DIR', default=os.path.join(config.path_root, 'fixtures', 'history'),
+                        help='The directory of canned pages named CODE_PAGE.html')
+    parser.add_argument('-PORT', default=8000, type=int,
+                        help='The port to listen on')
+
+    args = parser.parse_args()
+    server = serve(args.DIR, port=args.PORT)
+    print('serving {} at {}'.format(args.DIR, server.url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,283 @@
+import os
+import json
+import glob
+import logging
+import argparse
+import textwrap
+from logging import getLogger
+import numpy as np
+import config
+
+
+logger = getLogger(__name__)
+
+# column name -> dtype of each per-code column file
+FIELDS = [('date',    'datetime64[D]'),
+          ('start',   'float64'),
+          ('end',     'float64'),
+          ('low',     'float64'),
+          ('high',    'float64'),
+          ('volumn',  'int64'),
+          ('end_adj', 'float64'),
+          ('div',     'int8')]
+DTYPES = dict(FIELDS)
+
+
+class PriceStore(object):
+    '''
+    Columnar binary database of stock prices.
+
+    Each code owns a directory holding one raw binary file per column
+    and a `meta.json` recording the company name, the number of valid rows
+    and the generation of the column files. Readers only trust the rows
+    counted in `meta.json`, which is replaced atomically, so appending
+    bars never rewrites old ones and an interrupted write never corrupts
+    what was stored before.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def codes(self):
+        paths = glob.glob(os.path.join(self.root, '*', 'meta.json'))
+        return sorted(os.path.basename(os.path.dirname(p)) for p in paths)
+
+    def __contains__(self, code):
+        return os.path.exists(self._meta_path(code))
+
+    def name(self, code):
+        return self._read_meta(code)['name']
+
+    def length(self, code):
+        return self._read_meta(code)['length']
+
+    def version(self, code):
+        '''
+        Return (generation, length) of a code, which changes whenever
+        its series is written, appended or merged.
+        '''
+        meta = self._read_meta(code)
+        return meta['generation'], meta['length']
+
+    def read(self, code, mmap=True):
+        '''
+        Read all the columns of a code.
+
+        Args:
+            code (str): a stock code.
+            mmap (bool): if True, columns are read-only memory maps
+                of the files instead of arrays loaded in memory.
+        Returns:
+            dict: column name -> 1-D array sorted by date.
+        '''
+        meta = self._read_meta(code)
+        columns = {}
+        for field, dtype in FIELDS:
+            path = self._column_path(code, field, meta['generation'])
+            if meta['length'] == 0:
+                columns[field] = np.empty(0, dtype=dtype)
+            elif mmap:
+                columns[field] = np.memmap(path, dtype=dtype, mode='r', shape=(meta['length'],))
+            else:
+                columns[field] = np.fromfile(path, dtype=dtype, count=meta['length'])
+        return columns
+
+    def write(self, code, name, columns):
+        '''
+        Replace the whole series of a code atomically.
+        '''
+        columns = normalize(columns)
+        meta = self._read_meta(code) if code in self else None
+        generation = 0 if meta is None else meta['generation'] + 1
+        os.makedirs(self._code_path(code), exist_ok=True)
+        for field, dtype in FIELDS:
+            with open(self._column_path(code, field, generation), 'wb') as f:
+                columns[field].tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        self._write_meta(code, {'name': name,
+                                'length': len(columns['date']),
+                                'generation': generation})
+        self._remove_stale(code, generation)
+
+    def append(self, code, name, columns):
+        '''
+        Append bars later than the last stored date to the series of a code.
+        '''
+        if code not in self:
+            self.write(code, name, columns)
+            return
+        columns = normalize(columns)
+        meta = self._read_meta(code)
+        if len(columns['date']) == 0:
+            return
+        last = self.last_date(code)
+        if last is not None and columns['date'][0] <= last:
+            raise ValueError('cannot append bars of {} dated on or before {}'.format(code, last))
+        for field, dtype in FIELDS:
+            with open(self._column_path(code, field, meta['generation']), 'r+b') as f:
+                # drop whatever an interrupted append left behind the valid rows
+                f.truncate(meta['length'] * np.dtype(dtype).itemsize)
+                f.seek(0, os.SEEK_END)
+                columns[field].tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        self._write_meta(code, {'name': name,
+                                'length': meta['length'] + len(columns['date']),
+                                'generation': meta['generation']})
+
+    def merge(self, code, name, columns):
+        '''
+        Merge bars into the series of a code. Bars of dates already stored
+        are replaced by the new ones. Only if some bar is not later than
+        the last stored date are the files rewritten; otherwise bars are appended.
+        '''
+        columns = normalize(columns)
+        last = self.last_date(code) if code in self else None
+        if last is None or len(columns['date']) == 0 or columns['date'][0] > last:
+            self.append(code, name, columns)
+            return
+        stored = self.read(code, mmap=False)
+        # normalize keeps the later, i.e. the new, bar of a duplicated date
+        merged = {field: np.concatenate([stored[field], columns[field]]) for field, dtype in FIELDS}
+        self.write(code, name, merged)
+
+    def last_date(self, code):
+        '''
+        Return the last stored date of a code as np.datetime64,
+        or None if nothing is stored.
+        '''
+        meta = self._read_meta(code)
+        if meta['length'] == 0:
+            return None
+        path = self._column_path(code, 'date', meta['generation'])
+        return np.memmap(path, dtype=DTYPES['date'], mode='r', shape=(meta['length'],))[-1]
+
+    def _code_path(self, code):
+        return os.path.join(self.root, str(code))
+
+    def _meta_path(self, code):
+        return os.path.join(self._code_path(code), 'meta.json')
+
+    def _column_path(self, code, field, generation):
+        return os.path.join(self._code_path(code), '{}.{}.bin'.format(field, generation))
+
+    def info(self):
+        '''
+        Return the metadata of the whole store kept in `store.json`,
+        e.g. whether a legacy JSON database has been migrated into it.
+        '''
+        try:
+            with open(self._info_path(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def update_info(self, **info):
+        os.makedirs(self.root, exist_ok=True)
+        self._write_json(self._info_path(), dict(self.info(), **info))
+
+    def _info_path(self):
+        return os.path.join(self.root, 'store.json')
+
+    def _read_meta(self, code):
+        with open(self._meta_path(code), 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, code, meta):
+        self._write_json(self._meta_path(code), meta)
+
+    def _write_json(self, path, meta):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove_stale(self, code, generation):
+        for field, dtype in FIELDS:
+            for path in glob.glob(os.path.join(self._code_path(code), field + '.*.bin')):
+                if path != self._column_path(code, field, generation):
+                    os.remove(path)
+
+
+def normalize(columns):
+    '''
+    Convert a mapping of column name -> array-like (e.g. a DataFrame)
+    into typed arrays sorted by date without duplicated dates.
+    '''
+    dates = np.asarray(columns['date']).astype(DTYPES['date'])
+    order = np.argsort(dates, kind='mergesort')
+    # keep the last occurrence of a duplicated date
+    keep = np.ones(len(order), dtype=bool)
+    keep[:-1] = dates[order][1:] != dates[order][:-1]
+    order = order[keep]
+    normalized = {}
+    for field, dtype in FIELDS:
+        if field == 'div' and field not in columns:
+            values = np.zeros(len(dates), dtype=dtype)
+        else:
+            values = np.asarray(columns[field])
+        normalized[field] = np.ascontiguousarray(values[order].astype(dtype))
+    return normalized
+
+
+def migrate_json(json_path, store, resume=False):
+    '''
+    Copy every code of a legacy JSON database into a PriceStore
+    and mark the store as migrated once every code is written.
+    Records with missing values are skipped, as dict2dataframe
+    used to drop them anyway.
+
+    Args:
+        resume (bool): if True, codes already in the store are kept,
+            so that an interrupted migration is completed without
+            overwriting what was written or scraped since.
+    '''
+    logger.info('migrating {} into {}'.format(json_path, store.root))
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+    for code, entry in data.items():
+        if resume and code in store:
+            continue
+        records = [(date, record) for date, record in entry['data'].items()
+                   if all(record.get(field) is not None and record[field] == record[field]
+                          for field, dtype in FIELDS[1:-1])]
+        columns = {'date': [date for date, record in records]}
+        for field, dtype in FIELDS[1:]:
+            columns[field] = [record.get(field, 0) for date, record in records]
+        store.write(code, entry['name'], columns)
+    store.update_info(migrated=os.path.abspath(json_path))
+    logger.info('migrated {} codes'.format(len(data)))
+
+
+def open_store(root=None, json_path=None):
+    '''
+    Open the price database, migrating the legacy JSON database once.
+    A migration interrupted before it marked the store as migrated
+    is resumed the next time.
+    '''
+    root = config.store_path if root is None else root
+    json_path = config.json_path if json_path is None else json_path
+    store = PriceStore(root)
+    if os.path.exists(json_path) and 'migrated' not in store.info():
+        migrate_json(json_path, store, resume=True)
+    return store
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Migrate a JSON database of stock prices into the columnar store.
+                             Codes already in the store are overwritten.
+                             """))
+    parser.add_argument('-JSON', default=config.json_path,
+                        help='The path of the JSON database to migrate')
+    parser.add_argument('-STORE', default=config.store_path,
+                        help='The directory of the columnar store')
+
+    args = parser.parse_args()
+    migrate_json(args.JSON, PriceStore(args.STORE))
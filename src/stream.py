@@ -0,0 +1,317 @@
+import os
+import json
+import math
+import argparse
+import textwrap
+import collections
+import numpy as np
+import config
+import calc
+import store
+
+# Streaming counterparts of the kernels in calc.
+# `warm_up` calculates an indicator over a historical series with the
+# vectorized kernels, returns it and leaves the object ready for `update`,
+# which takes one new bar in O(1) and returns the indicator on that bar.
+# They follow the NaN semantics of calc.
+
+NAN = float("nan")
+
+
+class SimpleAverage(object):
+
+    def __init__(self, n):
+        self.n = n
+        self.window = collections.deque(maxlen=n)
+        self.total = 0.
+        self.n_nan = 0
+        self.n_seen = 0
+
+    def update(self, x):
+        x = float(x)
+        if len(self.window) == self.n:
+            old = self.window[0]
+            if math.isnan(old):
+                self.n_nan -= 1
+            else:
+                self.total -= old
+        self.window.append(x)
+        if math.isnan(x):
+            self.n_nan += 1
+        else:
+            self.total += x
+        self.n_seen += 1
+        if self.n_seen % self.n == 0:
+            # cancel the rounding errors accumulated by the running total
+            self.total = math.fsum(v for v in self.window if not math.isnan(v))
+        if len(self.window) < self.n or self.n_nan > 0:
+            return NAN
+        return self.total / self.n
+
+    def warm_up(self, v):
+        self.__init__(self.n)
+        for x in v[-self.n:]:
+            self.update(x)
+        return calc.calc_avg_simple(v, self.n, dtype="float64")
+
+
+class ExpAverage(object):
+
+    def __init__(self, n):
+        self.n = n
+        self.window = SimpleAverage(n)
+        self.value = NAN
+
+    def update(self, x):
+        x = float(x)
+        seed = self.window.update(x)
+        if math.isnan(seed):
+            self.value = NAN
+        elif math.isnan(self.value):
+            self.value = seed
+        else:
+            self.value = (2*x + (self.n-1)*self.value) / (self.n+1)
+        return self.value
+
+    def warm_up(self, v):
+        v_avg = calc.calc_avg_exp(v, self.n, dtype="float64")
+        self.window.warm_up(v)
+        self.value = float(v_avg[-1]) if len(v_avg) else NAN
+        return v_avg
+
+
+class RollingMin(object):
+    '''
+    Minimum (or maximum if sign is -1) over the last n values
+    kept by a monotonic deque of (index, value).
+    '''
+
+    def __init__(self, n, sign=1):
+        self.n = n
+        self.sign = sign
+        self.deque = collections.deque()
+        self.n_seen = 0
+        self.last_nan = -n
+
+    def update(self, x):
+        x = float(x)
+        i = self.n_seen
+        self.n_seen += 1
+        if math.isnan(x):
+            # nothing before a NaN matters once the NaN leaves the window
+            self.last_nan = i
+            self.deque.clear()
+        else:
+            y = self.sign * x
+            while self.deque and self.deque[-1][1] >= y:
+                self.deque.pop()
+            self.deque.append((i, y))
+            while self.deque[0][0] <= i - self.n:
+                self.deque.popleft()
+        if i < self.n-1 or i - self.last_nan < self.n:
+            return NAN
+        return self.sign * self.deque[0][1]
+
+
+class Stochastic(object):
+
+    def __init__(self, n_K=5, n_D=3, n_D_slow=3):
+        self.n_K = n_K
+        self.n_D = n_D
+        self.n_D_slow = n_D_slow
+        self.low = RollingMin(n_K)
+        self.high = RollingMin(n_K, sign=-1)
+        self.numer = SimpleAverage(n_D)
+        self.denom = SimpleAverage(n_D)
+        self.slow = SimpleAverage(n_D_slow)
+
+    def update(self, x):
+        x = float(x)
+        low = self.low.update(x)
+        high = self.high.update(x)
+        numer = self.numer.update(x - low)
+        denom = self.denom.update(high - low)
+        if denom == 0:
+            D = NAN if numer == 0 else math.copysign(math.inf, numer)
+        else:
+            D = 100 * numer / denom
+        return D, self.slow.update(D)
+
+    def warm_up(self, v):
+        # the state only depends on the last few values
+        self.__init__(self.n_K, self.n_D, self.n_D_slow)
+        for x in v[-(self.n_K + self.n_D + self.n_D_slow - 2):]:
+            self.update(x)
+        v_D = calc.calc_D(v, self.n_K, self.n_D, dtype="float64")
+        return v_D, calc.calc_avg_simple(v_D, self.n_D_slow, dtype="float64")
+
+
+class MACD(object):
+
+    def __init__(self, n_short=12, n_long=26, n_signal=9):
+        self.short = ExpAverage(n_short)
+        self.long = ExpAverage(n_long)
+        self.signal = ExpAverage(n_signal)
+
+    def update(self, x):
+        macd = self.short.update(x) - self.long.update(x)
+        return macd, self.signal.update(macd)
+
+    def warm_up(self, v):
+        v_macd = self.short.warm_up(v) - self.long.warm_up(v)
+        return v_macd, self.signal.warm_up(v_macd)
+
+
+class Indicators(object):
+    '''
+    MACD, signal, D and slow D of a code updated bar by bar.
+
+    The exponential averages start from the first bar of the series
+    given to `warm_up` instead of the first bar of a report period,
+    which makes a difference only for series shorter than a few months.
+    '''
+
+    def __init__(self, n_short=12, n_long=26, n_signal=9, n_K=5, n_D=3, n_D_slow=3):
+        self.macd = MACD(n_short, n_long, n_signal)
+        self.stochastic = Stochastic(n_K, n_D, n_D_slow)
+        self.last = {"macd": NAN, "signal": NAN, "D": NAN, "D_slow": NAN}
+        self.date = None
+
+    def update(self, x, date=None):
+        macd, signal = self.macd.update(x)
+        D, D_slow = self.stochastic.update(x)
+        self.last = {"macd": macd, "signal": signal, "D": D, "D_slow": D_slow}
+        self.date = None if date is None else str(date)
+        return self.last
+
+    def warm_up(self, v, dates=None):
+        v = np.asarray(v, dtype="float64")
+        v_macd, v_signal = self.macd.warm_up(v)
+        v_D, v_D_slow = self.stochastic.warm_up(v)
+        if len(v):
+            self.last = {"macd": float(v_macd[-1]), "signal": float(v_signal[-1]),
+                         "D": float(v_D[-1]), "D_slow": float(v_D_slow[-1])}
+            self.date = None if dates is None else str(dates[-1])
+        return {"macd": v_macd, "signal": v_signal, "D": v_D, "D_slow": v_D_slow}
+
+    def promise(self):
+        # judged on indicators rounded as postprocess.calculate_indicators does
+        last = {k: np.round(v) for k, v in self.last.items()}
+        return calc.judge(last["macd"], last["signal"], last["D_slow"])
+
+
+def to_dict(obj):
+    '''
+    Convert a streaming indicator into a JSON serializable dict.
+    '''
+    if isinstance(obj, collections.deque):
+        return {"deque": [to_dict(v) for v in obj], "maxlen": obj.maxlen}
+    if isinstance(obj, (list, tuple)):
+        return [to_dict(v) for v in obj]
+    if isinstance(obj, dict):
+        return {k: to_dict(v) for k, v in obj.items()}
+    if type(obj).__name__ in CLASSES:
+        return {"class": type(obj).__name__, "state": to_dict(vars(obj))}
+    return obj
+
+
+def from_dict(d):
+    '''
+    Restore a streaming indicator converted by to_dict.
+    '''
+    if isinstance(d, list):
+        return [from_dict(v) for v in d]
+    if not isinstance(d, dict):
+        return d
+    if set(d) == {"deque", "maxlen"}:
+        return collections.deque([tuple(v) if isinstance(v, list) else v for v in d["deque"]],
+                                 maxlen=d["maxlen"])
+    if set(d) == {"class", "state"}:
+        obj = CLASSES[d["class"]].__new__(CLASSES[d["class"]])
+        obj.__dict__.update(from_dict(d["state"]))
+        return obj
+    return {k: from_dict(v) for k, v in d.items()}
+
+
+CLASSES = {c.__name__: c for c in [SimpleAverage, ExpAverage, RollingMin, Stochastic, MACD, Indicators]}
+
+
+def state_path(prices, code):
+    return os.path.join(prices.root, str(code), "indicators.json")
+
+
+def save(path, indicators, version=None):
+    '''
+    Persist indicators with the store.PriceStore.version of the series
+    they were calculated over.
+    '''
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": version, "indicators": to_dict(indicators)}, f)
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    '''
+    Returns:
+        Indicators: the persisted indicators.
+        list: the version of the series they were calculated over,
+            None if unknown.
+    '''
+    with open(path, "r") as f:
+        d = json.load(f)
+    if set(d) != {"version", "indicators"}:
+        # saved without a version
+        return from_dict(d), None
+    return from_dict(d["indicators"]), d["version"]
+
+
+def update_promises(prices, codes):
+    '''
+    Bring the indicators persisted beside the database up to date with
+    the bars stored since the last update and judge each code.
+    Codes without persisted indicators, or whose stored bars have been
+    rewritten since, e.g. re-adjusted after a split or with their last bar
+    replaced, are warmed up from their whole history.
+
+    Returns:
+        dict: code -> "BUY", "SELL" or "STAY".
+    '''
+    promises = {}
+    for code in codes:
+        path = state_path(prices, code)
+        columns = prices.read(code)
+        valid = ~np.isnan(columns["end_adj"]) # deal with stock division
+        dates = columns["date"][valid]
+        values = columns["end_adj"][valid]
+        version = list(prices.version(code))
+        indicators, saved_version = load(path) if os.path.exists(path) else (None, None)
+        # appending bars keeps the generation, rewriting any bar changes it
+        if indicators is None or indicators.date is None or saved_version is None \
+                or saved_version[0] != version[0]:
+            indicators = Indicators()
+            indicators.warm_up(values, dates)
+        else:
+            i = np.searchsorted(dates, np.datetime64(indicators.date, "D"), side="right")
+            for date, x in zip(dates[i:], values[i:]):
+                indicators.update(x, date)
+        save(path, indicators, version)
+        promises[code] = indicators.promise()
+    return promises
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Update the indicators of each code with the bars added to the database
+                             since the last update and print whether it is BUY, SELL or STAY.
+                             """))
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
+    args = parser.parse_args()
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
+    prices = store.open_store()
+    for code, promise in update_promises(prices, config.codes).items():
+        print(promise, code)
@@ -0,0 +1,199 @@
+import datetime
+import argparse
+import textwrap
+import itertools
+import multiprocessing
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+import config
+import calc
+import panel
+import screen
+import store
+
+# Signals of the rule of screen.screen_panel for many parameter sets.
+# Parameter sets are sorted so that those sharing windows are neighbours,
+# and the grid is split into chunks of parameter sets times chunks of codes
+# calculated in parallel. Inside a chunk each exponential average, MACD and
+# D is calculated once per distinct window and shared by the parameter sets
+# using it, and memory is bounded by the size of the chunks.
+
+PARAMS = ["n_short", "n_long", "n_signal", "n_K", "n_D", "n_D_slow"]
+DEFAULTS = {"n_short": 12, "n_long": 26, "n_signal": 9, "n_K": 5, "n_D": 3, "n_D_slow": 3}
+
+BUY = 1
+SELL = -1
+STAY = 0
+
+
+def grid(**values):
+    '''
+    Every combination of the given values of parameters,
+    e.g. grid(n_short=[8, 12], n_long=[26, 30]).
+    The other parameters take their default values.
+    '''
+    unknown = set(values) - set(PARAMS)
+    if unknown:
+        raise TypeError("unknown parameters: {}".format(", ".join(sorted(unknown))))
+    names = [name for name in PARAMS if name in values]
+    return [dict(DEFAULTS, **dict(zip(names, combination)))
+            for combination in itertools.product(*[values[name] for name in names])]
+
+
+def judge_chunk(m_compact, param_sets, low=20, high=80):
+    '''
+    Args:
+        m_compact (np.ndarray): prices of a chunk of codes compacted by screen.compact.
+        param_sets (list of dict): the parameter sets to judge with.
+    Returns:
+        np.ndarray: int8 array of BUY, SELL or STAY indexed by (param set, code, date).
+    '''
+    avg_exp, macd, D = {}, {}, {}
+    out = np.zeros((len(param_sets),) + m_compact.shape, dtype="int8")
+    for i, params in enumerate(param_sets):
+        for n in [params["n_short"], params["n_long"]]:
+            if n not in avg_exp:
+                avg_exp[n] = calc.calc_avg_exp(m_compact, n)
+        key_macd = params["n_short"], params["n_long"]
+        if key_macd not in macd:
+            macd[key_macd] = avg_exp[params["n_short"]] - avg_exp[params["n_long"]]
+        key_D = params["n_K"], params["n_D"]
+        if key_D not in D:
+            D[key_D] = calc.calc_D(m_compact, params["n_K"], params["n_D"])
+        m_signal = calc.calc_avg_exp(macd[key_macd], params["n_signal"])
+        m_D_slow = calc.calc_avg_simple(D[key_D], params["n_D_slow"])
+        buy, sell = calc.judge_batch(np.round(macd[key_macd]), np.round(m_signal),
+                                     np.round(m_D_slow), low, high)
+        out[i][buy] = BUY
+        out[i][sell] = SELL
+    return out
+
+
+_panel = None
+
+def _init_worker(m_compact):
+    global _panel
+    _panel = m_compact
+
+def _judge_task(task):
+    i_params, i_codes, param_sets, low, high = task
+    return i_params, i_codes, judge_chunk(_panel[i_codes], param_sets, low, high)
+
+
+def sweep(m, param_sets, low=20, high=80, jobs=1, chunk_params=16, chunk_codes=32):
+    '''
+    Judge every code on every date for every parameter set.
+
+    Args:
+        m (np.ndarray): a 2-D array of prices whose rows are codes and
+            whose columns are dates, NaN where a code has no bar.
+        param_sets (list of dict): parameter sets, e.g. made by `grid`.
+        jobs (int): the number of processes.
+        chunk_params (int): the number of parameter sets calculated together.
+        chunk_codes (int): the number of codes calculated together.
+    Returns:
+        list of dict: the parameter sets in the order of the first axis.
+        np.ndarray: int8 array of BUY, SELL or STAY indexed by (param set, code, date).
+    '''
+    param_sets = sorted((dict(DEFAULTS, **params) for params in param_sets),
+                        key=lambda params: [params[name] for name in PARAMS])
+    m_compact, order = screen.compact(m)
+    tasks = [(slice(i, i+chunk_params), slice(j, j+chunk_codes), param_sets[i:i+chunk_params], low, high)
+             for i in range(0, len(param_sets), chunk_params)
+             for j in range(0, m.shape[0], chunk_codes)]
+    out = np.zeros((len(param_sets),) + m.shape, dtype="int8")
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (m_compact,))
+        results = pool.imap_unordered(_judge_task, tasks)
+    else:
+        pool = None
+        _init_worker(m_compact)
+        results = map(_judge_task, tasks)
+    for i_params, i_codes, block in results:
+        # the bars of a code are put back on its dates,
+        # the padding of the compacted panel is never judged
+        _order = np.broadcast_to(order[i_codes], block.shape)
+        np.put_along_axis(out[i_params, i_codes], _order, block, axis=2)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return param_sets, out
+
+
+def summarize(param_sets, signals, m, horizon=5):
+    '''
+    The hit rate and mean return of the BUY and SELL signals of each
+    parameter set `horizon` bars later, as screen.backtest reports them.
+    '''
+    m_return = screen.forward_returns(m, horizon)
+    known = ~np.isnan(m_return)
+    rows = []
+    for params, s in zip(param_sets, signals):
+        row = dict(params)
+        for side, value, sign in [("buy", BUY, 1), ("sell", SELL, -1)]:
+            pnl = sign * m_return[(s == value) & known]
+            row["n_" + side] = len(pnl)
+            row[side + "_hit_rate"] = (pnl > 0).mean() if len(pnl) else np.nan
+            row[side + "_return"] = pnl.mean() if len(pnl) else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(start_date, end_date, param_sets, horizon=5, low=20, high=80, jobs=1):
+    prices = store.open_store()
+    codes = [code for code in config.codes if code in prices]
+    universe = panel.Panel.load(prices, codes, start_date, end_date)
+    dates, m = universe.dates, universe.matrix('end_adj')
+    param_sets, signals = sweep(m, param_sets, low, high, jobs)
+    with pd.option_context('display.max_rows', None, 'display.width', None):
+        print(summarize(param_sets, signals, m, horizon))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Backtest the rule of screen.py with every combination
+                             of the given windows of the indicators.
+                             If -START and -END arguments are not specified,
+                             it covers the 2 years up to the day of the sweep.
+                             """))
+    parser.add_argument('-START', default=None,
+                        help='The date from when to sweep. Its format must be YYYY-MM-DD')
+    parser.add_argument('-END', default=None,
+                        help='The date until when to sweep. Its format must be YYYY-MM-DD')
+    for name in PARAMS:
+        parser.add_argument('-' + name[2:].upper(), dest=name, nargs='+', type=int, default=[DEFAULTS[name]],
+                            help='The values of {} to try'.format(name))
+    parser.add_argument('-HORIZON', default=5, type=int,
+                        help='The number of bars a position is held for')
+    parser.add_argument('-LOW', default=20, type=float,
+                        help='Slow D at most which a rising MACD is a BUY')
+    parser.add_argument('-HIGH', default=80, type=float,
+                        help='Slow D at least which a falling MACD is a SELL')
+    parser.add_argument('-JOBS', default=1, type=int,
+                        help='The number of processes calculating chunks of the grid')
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
+
+    args = parser.parse_args()
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
+
+    if args.END is None:
+        end_datetime = datetime.datetime.today()
+    else:
+        end_datetime = datetime.datetime.strptime(args.END, '%Y-%m-%d')
+
+    if args.START is None:
+        start_datetime = end_datetime - relativedelta(years=2)
+    else:
+        start_datetime = datetime.datetime.strptime(args.START, '%Y-%m-%d')
+
+    end_date = end_datetime.strftime('%Y-%m-%d')
+    start_date = start_datetime.strftime('%Y-%m-%d')
+
+    param_sets = grid(**{name: getattr(args, name) for name in PARAMS})
+    main(start_date, end_date, param_sets, args.HORIZON, args.LOW, args.HIGH, args.JOBS)
@@ -1,78 +1,152 @@
 import os
 import sys
+import matplotlib
+matplotlib.use('Agg') # charts are only saved to files
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib import ticker
-from matplotlib.lines import Line2D
-from matplotlib.patches import Rectangle
+import matplotlib.colors as mcolors
+from matplotlib.collections import LineCollection, PolyCollection
 import datetime
 from dateutil import relativedelta
 import numpy as np
 import calc
 
 def format_axis(fig, ax, datetimes):
-    ax.grid()
+    ax.grid(True)
     days_margin = relativedelta.relativedelta(days=3)
     ax.set_xlim([datetimes[0]-days_margin, datetimes[-1]+days_margin])
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
     ax.xaxis.set_major_locator(mdates.DayLocator(interval=7))
-    fig.autofmt_xdate(rotation=90)    
+    fig.autofmt_xdate(rotation=90)
     return fig, ax
 
-def draw_candlestick(df, path=None):
-    nums_date = mdates.date2num(df.index).reshape(-1, 1)
-    mat_ohlc = df[["start", "high", "low", "end"]].values
-    mat_ohlc = np.concatenate([nums_date, mat_ohlc], axis=1)
-    fig, ax = plt.subplots(figsize=(16, 8))
-    ax = candlestick(ax, mat_ohlc)
-    fig, ax = format_axis(fig, ax, df.index)
-    if path is not None:
-        fig.savefig(path, bbox_inches='tight')
-    plt.close(fig)
-    return
+def draw_candlestick(df, path=None, averages=None):
+    default_renderer().draw_candlestick(df, path, averages)
 
 def draw_indicators(df, indicators, path):
-    fig, ax = plt.subplots(figsize=(16, 8))
-    for ind in indicators:
-        ax.plot(df.index, df[ind], label=ind)
-    ax.legend()
-    fig, ax = format_axis(fig, ax, df.index)
-    if path is not None:
-        fig.savefig(path, bbox_inches='tight')
-    plt.close(fig)
+    default_renderer().draw_indicators(df, indicators, path)
 
-def candlestick(ax, quotes, width=0.2, colorup='k', colordown='r', alpha=1.0):
+_renderer = None
 
-    OFFSET = width / 2.0
+def default_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = ChartRenderer()
+    return _renderer
+
+class ChartRenderer(object):
+    '''
+    Draw the charts of many codes on figures created once,
+    swapping the data of each code into the same artists.
+    '''
 
-    for q in quotes:
-        
-        t, open, high, low, close = q[:5]
+    def __init__(self, figsize=(16, 8)):
+        self.figsize = figsize
+        self._candle = None
+        self._indicators = {}
 
-        if close >= open:
-            color = colorup
-            lower = open
-            height = close - open
+    def draw_candlestick(self, df, path=None, averages=None):
+        '''
+        Args:
+            df (pd.DataFrame): prices indexed by date.
+            path (str): the path to save the chart.
+            averages (dict): days -> precomputed exponential moving average
+                of df["end"]. Those over 12 and 26 days are calculated if None.
+        '''
+        if self._candle is None:
+            fig, ax = plt.subplots(figsize=self.figsize)
+            wicks = LineCollection([], linewidths=0.5, antialiaseds=True)
+            bodies = PolyCollection([])
+            ax.add_collection(wicks)
+            ax.add_collection(bodies)
+            self._candle = fig, ax, wicks, bodies, {}
+        fig, ax, wicks, bodies, lines = self._candle
+        nums_date = mdates.date2num(df.index).reshape(-1, 1)
+        mat_ohlc = df[["start", "high", "low", "end"]].values
+        mat_ohlc = np.concatenate([nums_date, mat_ohlc], axis=1)
+        candlestick(ax, mat_ohlc, wicks=wicks, bodies=bodies, lines=lines, averages=averages)
+        fig, ax = format_axis(fig, ax, df.index)
+        if path is not None:
+            fig.savefig(path, bbox_inches='tight')
+
+    def draw_indicators(self, df, indicators, path):
+        key = tuple(indicators)
+        if key not in self._indicators:
+            fig, ax = plt.subplots(figsize=self.figsize)
+            lines = [ax.plot([], [], label=ind)[0] for ind in indicators]
+            ax.legend()
+            self._indicators[key] = fig, ax, lines
+        fig, ax, lines = self._indicators[key]
+        for ind, line in zip(indicators, lines):
+            line.set_data(df.index, df[ind])
+        # the view is reset explicitly, since autoscaling over no finite
+        # value, e.g. a short history, keeps the view of the previous code
+        values = df[list(indicators)].values.astype("float64")
+        if np.isfinite(values).any():
+            ax.relim()
+            ax.set_autoscaley_on(True)
+            ax.autoscale_view()
         else:
-            color = colordown
-            lower = close
-            height = open - close
+            ax.set_ylim(-1, 1)
+        fig, ax = format_axis(fig, ax, df.index)
+        if path is not None:
+            fig.savefig(path, bbox_inches='tight')
+
+    def close(self):
+        figs = [self._candle[0]] if self._candle is not None else []
+        figs += [fig for fig, ax, lines in self._indicators.values()]
+        for fig in figs:
+            plt.close(fig)
+        self._candle = None
+        self._indicators = {}
+
+def candlestick(ax, quotes, width=0.2, colorup='k', colordown='r', alpha=1.0,
+                wicks=None, bodies=None, lines=None, averages=None):
+    '''
+    Draw candles as one LineCollection of wicks and one PolyCollection
+    of bodies. Collections and lines of moving averages given by
+    a ChartRenderer are updated in place instead of being added.
+    '''
+    OFFSET = width / 2.0
+
+    t, open, high, low, close = quotes[:, :5].T
+    up = close >= open
+    colors = np.where(up[:, None], mcolors.to_rgba(colorup, alpha),
+                      mcolors.to_rgba(colordown, alpha))
+    lower = np.where(up, open, close)
+    upper = np.where(up, close, open)
+
+    segments = np.stack([np.stack([t, low], axis=1), np.stack([t, high], axis=1)], axis=1)
+    verts = np.stack([np.stack([t - OFFSET, lower], axis=1),
+                      np.stack([t - OFFSET, upper], axis=1),
+                      np.stack([t + OFFSET, upper], axis=1),
+                      np.stack([t + OFFSET, lower], axis=1)], axis=1)
+    if wicks is None:
+        wicks = LineCollection([], linewidths=0.5, antialiaseds=True)
+        ax.add_collection(wicks)
+    if bodies is None:
+        bodies = PolyCollection([])
+        ax.add_collection(bodies)
+    wicks.set_segments(segments)
+    wicks.set_color(colors)
+    bodies.set_verts(verts)
+    bodies.set_facecolor(colors)
+    bodies.set_edgecolor(colors)
 
-        vline = Line2D(xdata=(t, t), ydata=(low, high),
-                       color=color, linewidth=0.5, antialiased=True)
+    if averages is None:
+        averages = {n: calc.calc_avg_exp(close, n) for n in [12, 26]}
+    lines = {} if lines is None else lines
+    for n, v_avg in averages.items():
+        if n not in lines:
+            lines[n] = ax.plot([], [], label="exponential moving average over {} days".format(n))[0]
+            ax.legend()
+        lines[n].set_data(t, v_avg)
 
-        rect = Rectangle(xy=(t - OFFSET, lower),
-                         width=width, height=height,
-                         facecolor=color, edgecolor=color)
-        
-        rect.set_alpha(alpha)
-        ax.add_line(vline)
-        ax.add_patch(rect)
-    ax.autoscale_view()
-    
-    ax.plot(quotes[:, 0], calc.calc_avg_exp(quotes[:, -1], 12), 
-            label="exponential moving average over 12 days")
-    ax.plot(quotes[:, 0], calc.calc_avg_exp(quotes[:, -1], 26), 
-            label="exponential moving average over 26 days")
-    ax.legend()    
-    return ax
\ No newline at end of file
+    # collections are not taken into account by autoscaling
+    values = np.concatenate([low, high, open, close] + [np.asarray(v, dtype="float64") for v in averages.values()])
+    if np.isfinite(values).any():
+        y_min, y_max = np.nanmin(values), np.nanmax(values)
+        y_margin = ax.margins()[1] * (y_max - y_min)
+        ax.set_ylim(y_min - y_margin, y_max + y_margin)
+    return ax
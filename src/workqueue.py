@@ -0,0 +1,372 @@
+import io
+import os
+import time
+import socket
+import logging
+import sqlite3
+import argparse
+import textwrap
+import datetime
+import contextlib
+import multiprocessing
+from logging import getLogger
+from dateutil import relativedelta
+import numpy as np
+import config
+import store
+import scrape
+from cache import PageCache
+
+
+logging.basicConfig(level=logging.INFO)
+logger = getLogger(__name__)
+
+# Scraping shared by several processes or hosts through a queue of
+# (code, start date, end date) tasks in one SQLite file, e.g. on a shared
+# volume. A worker leases a task for some seconds, renewed after each page,
+# scrapes it and commits its columns into the queue. A task whose lease
+# expires, because its worker died or hung, is leased again by another
+# worker. The results are merged into the price database by a single
+# process afterwards, so the workers never write the database.
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    id          INTEGER PRIMARY KEY,
+    code        TEXT NOT NULL,
+    start_date  TEXT NOT NULL,
+    end_date    TEXT NOT NULL,
+    state       TEXT NOT NULL DEFAULT 'pending',
+    owner       TEXT,
+    lease_until REAL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    company     TEXT,
+    result      BLOB,
+    merged      INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (code, start_date, end_date)
+)
+'''
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class WorkQueue(object):
+    '''
+    A queue of scraping tasks in a SQLite file.
+
+    Every change is a transaction holding the write lock of the file, so any
+    number of processes may open the same queue. It relies on the locks of
+    the file system, which network file systems do not always honour.
+
+    Args:
+        path (str): the SQLite file, created if missing.
+        lease (float): the seconds a claimed task belongs to its worker.
+        max_attempts (int): the number of claims after which a task fails.
+    '''
+
+    def __init__(self, path, lease=600., max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60., isolation_level=None)
+        self._db.execute(SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def put(self, tasks):
+        '''
+        Add (code, start date, end date) tasks. Tasks already queued are ignored.
+
+        Returns:
+            int: the number of tasks added.
+        '''
+        with self._transaction() as db:
+            n = db.total_changes
+            db.executemany('INSERT OR IGNORE INTO tasks (code, start_date, end_date) VALUES (?, ?, ?)', tasks)
+            return db.total_changes - n
+
+    def claim(self, owner):
+        '''
+        Lease the first pending task, or a task whose lease has expired.
+
+        Returns:
+            tuple: the id, the code, the start date and the end date of the task,
+                or None if no task is available now.
+        '''
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('UPDATE tasks SET state = ?, error = ? '
+                       'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                       (FAILED, 'lease expired', LEASED, now, self.max_attempts))
+            task = db.execute('SELECT id, code, start_date, end_date FROM tasks '
+                              'WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY id LIMIT 1',
+                              (PENDING, LEASED, now)).fetchone()
+            if task is not None:
+                db.execute('UPDATE tasks SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1 '
+                           'WHERE id = ?', (LEASED, owner, now + self.lease, task[0]))
+        return task
+
+    def renew(self, task_id, owner):
+        '''
+        Extend the lease of a task still leased by `owner`, as a heartbeat.
+
+        Returns:
+            bool: False if the lease was lost to another worker.
+        '''
+        with self._transaction() as db:
+            cursor = db.execute('UPDATE tasks SET lease_until = ? WHERE id = ? AND owner = ? AND state = ?',
+                                (time.time() + self.lease, task_id, owner, LEASED))
+            return cursor.rowcount == 1
+
+    def complete(self, task_id, owner, company, columns):
+        '''
+        Commit the result of a task still leased by `owner`.
+
+        Returns:
+            bool: False if the lease was lost to another worker, whose result is kept instead.
+        '''
+        buffer = io.BytesIO()
+        np.savez(buffer, **columns)
+        with self._transaction() as db:
+            cursor = db.execute('UPDATE tasks SET state = ?, company = ?, result = ?, error = NULL '
+                                'WHERE id = ? AND owner = ? AND state = ?',
+                                (DONE, company, buffer.getvalue(), task_id, owner, LEASED))
+            return cursor.rowcount == 1
+
+    def fail(self, task_id, owner, error):
+        '''
+        Give a task back to the queue, or fail it after `max_attempts` claims.
+        '''
+        with self._transaction() as db:
+            db.execute('UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ? '
+                       'WHERE id = ? AND owner = ? AND state = ?',
+                       (self.max_attempts, FAILED, PENDING, error, task_id, owner, LEASED))
+
+    def active(self):
+        '''
+        Whether some task is pending or leased.
+        '''
+        return self._db.execute('SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)',
+                                (PENDING, LEASED)).fetchone()[0] > 0
+
+    def counts(self):
+        counts = dict.fromkeys([PENDING, LEASED, DONE, FAILED], 0)
+        counts.update(self._db.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+        counts['merged'] = self._db.execute('SELECT COUNT(*) FROM tasks WHERE merged = 1').fetchone()[0]
+        return counts
+
+    def failures(self):
+        '''
+        Returns:
+            list of tuple: the code, the start date, the end date and the last error of failed tasks.
+        '''
+        return self._db.execute('SELECT code, start_date, end_date, error FROM tasks '
+                                'WHERE state = ? ORDER BY id', (FAILED,)).fetchall()
+
+    def results(self):
+        '''
+        Yield the id, the code, the company name and the columns of every
+        task done but not merged yet, in the order of codes and dates.
+        '''
+        ids = [row[0] for row in self._db.execute(
+            'SELECT id FROM tasks WHERE state = ? AND merged = 0 ORDER BY code, start_date', (DONE,))]
+        for task_id in ids:
+            code, company, result = self._db.execute(
+                'SELECT code, company, result FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            with np.load(io.BytesIO(result)) as data:
+                columns = {field: data[field] for field, dtype in store.FIELDS}
+            yield task_id, code, company, columns
+
+    def mark_merged(self, task_id):
+        # the result is dropped once in the database, which keeps the queue small
+        with self._transaction() as db:
+            db.execute('UPDATE tasks SET merged = 1, result = NULL WHERE id = ?', (task_id,))
+
+
+def split_period(start_date, end_date, months=None):
+    '''
+    Split a period into consecutive periods of `months` months.
+
+    Returns:
+        list of tuple: start and end dates formatted as 'YYYY-MM-DD'.
+    '''
+    if not months:
+        return [(start_date, end_date)]
+    start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    periods = []
+    while start <= end:
+        following = start + relativedelta.relativedelta(months=months)
+        periods.append((start.strftime("%Y-%m-%d"),
+                        min(end, following - datetime.timedelta(days=1)).strftime("%Y-%m-%d")))
+        start = following
+    return periods
+
+
+def enqueue(queue, codes, start_date, end_date, months=None, incremental=False):
+    '''
+    Queue the codes over a period, split into tasks of `months` months if given.
+    With `incremental`, only the days missing in the database are queued
+    as scrape.specify_start_dates chooses them.
+
+    Returns:
+        int: the number of tasks added.
+    '''
+    if incremental:
+        start_dates = scrape.specify_start_dates(store.open_store(), codes, start_date, end_date)
+    else:
+        start_dates = {code: start_date for code in codes}
+    return queue.put([(code, start, end) for code in codes if code in start_dates
+                      for start, end in split_period(start_dates[code], end_date, months)])
+
+
+def work(queue_path, sleeptime=0.01, base_url=None, cache=None, retry=None,
+         lease=600., max_attempts=3, poll=5.):
+    '''
+    Claim and scrape tasks until none is pending or leased.
+    Tasks leased by other workers are waited for, since their
+    leases may expire and have to be taken over.
+
+    Returns:
+        int: the number of tasks this worker completed.
+    '''
+    queue = WorkQueue(queue_path, lease, max_attempts)
+    owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+    n_done = 0
+    while True:
+        task = queue.claim(owner)
+        if task is None:
+            if not queue.active():
+                break
+            time.sleep(poll)
+            continue
+        task_id, code, start_date, end_date = task
+
+        def heartbeat(code, page):
+            # a task taking longer than a lease keeps it as long as pages come
+            if not queue.renew(task_id, owner):
+                raise LeaseLost('the lease of {} from {} was lost'.format(code, start_date))
+
+        try:
+            company, columns = scrape.scrape(code, start_date, end_date, sleeptime, base_url, cache, retry,
+                                             on_page=heartbeat)
+        except LeaseLost as e:
+            logger.warning('{}, the other worker scrapes it'.format(e))
+            continue
+        except Exception as e:
+            logger.exception('failed to scrape {} from {} to {}'.format(code, start_date, end_date))
+            queue.fail(task_id, owner, '{}: {}'.format(type(e).__name__, e))
+            continue
+        if queue.complete(task_id, owner, company, columns):
+            n_done += 1
+        else:
+            logger.warning('the lease of {} from {} expired and its result is dropped'.format(code, start_date))
+    logger.info('{} tasks done by {}'.format(n_done, owner))
+    return n_done
+
+
+def merge(queue, prices):
+    '''
+    Merge the results of the tasks done into the database.
+
+    Returns:
+        int: the number of tasks merged.
+    '''
+    n_merged = 0
+    for task_id, code, company, columns in queue.results():
+        prices.merge(code, company, columns)
+        queue.mark_merged(task_id)
+        n_merged += 1
+    return n_merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=textwrap.dedent("""
+                             Scrape with workers on one or several hosts sharing a queue file.
+                               enqueue: queue the codes of the universe over a period.
+                               work:    run -WORKERS processes scraping queued tasks until none is left.
+                               merge:   merge the results into the database.
+                               status:  count the tasks in each state and list the failures.
+                             """))
+    parser.add_argument('ACTION', choices=['enqueue', 'work', 'merge', 'status'])
+    parser.add_argument('-QUEUE', default=config.queue_path,
+                        help='The SQLite file of the queue, shared by the workers')
+    parser.add_argument('-CODES', default=None,
+                        help='A file of one code per line replacing the codes of config.py')
+    parser.add_argument('-START', default=None,
+                        help='The date from when to retrieve stock prices. Its format must be YYYY-MM-DD')
+    parser.add_argument('-END', default=None,
+                        help='The date until when to retrieve stock prices. Its format must be YYYY-MM-DD')
+    parser.add_argument('-MONTH', default=1, type=int,
+                        help='The number of months the start date precedes prior to the end date')
+    parser.add_argument('-CHUNK', default=None, type=int,
+                        help='Split the period of each code into tasks of this number of months')
+    parser.add_argument('-INCREMENTAL', action='store_true',
+                        help='Queue only the days after the last date stored for each code')
+    parser.add_argument('-WORKERS', default=multiprocessing.cpu_count(), type=int,
+                        help='The number of worker processes on this host')
+    parser.add_argument('-SLEEP', default=0.01, type=float,
+                        help='The sleep time between each retrieval.')
+    parser.add_argument('-URL', default=config.history_url,
+                        help='The url of the history site, e.g. that of standin.py for testing.')
+    parser.add_argument('-NOCACHE', action='store_true',
+                        help='Neither read nor write the page cache.')
+    parser.add_argument('-RETRIES', default=4, type=int,
+                        help='The number of times a failed or throttled request is retried.')
+    parser.add_argument('-LEASE', default=600., type=float,
+                        help='The seconds without a page scraped after which a task is given to another worker')
+    parser.add_argument('-ATTEMPTS', default=3, type=int,
+                        help='The number of claims after which a task is failed')
+
+    args = parser.parse_args()
+    if args.CODES is not None:
+        config.codes = config.read_codes(args.CODES)
+    queue = WorkQueue(args.QUEUE, args.LEASE, args.ATTEMPTS)
+
+    if args.ACTION == 'enqueue':
+        end_datetime = datetime.datetime.today() if args.END is None else datetime.datetime.strptime(args.END, "%Y-%m-%d")
+        if args.START is None:
+            start_datetime = end_datetime - relativedelta.relativedelta(months=args.MONTH)
+        else:
+            start_datetime = datetime.datetime.strptime(args.START, "%Y-%m-%d")
+        n_added = enqueue(queue, config.codes, start_datetime.strftime("%Y-%m-%d"),
+                          end_datetime.strftime("%Y-%m-%d"), args.CHUNK, args.INCREMENTAL)
+        logger.info('{} tasks queued in {}'.format(n_added, args.QUEUE))
+
+    elif args.ACTION == 'work':
+        cache = None if args.NOCACHE else PageCache(config.cache_dir_path)
+        kwargs = dict(sleeptime=args.SLEEP, base_url=args.URL, cache=cache, retry=scrape.Retry(args.RETRIES),
+                      lease=args.LEASE, max_attempts=args.ATTEMPTS)
+        workers = [multiprocessing.Process(target=work, args=(args.QUEUE,), kwargs=kwargs)
+                   for _ in range(args.WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    elif args.ACTION == 'merge':
+        prices = store.open_store()
+        logger.info('{} tasks merged into {}'.format(merge(queue, prices), prices.root))
+
+    counts = queue.counts()
+    logger.info(', '.join('{} {}'.format(n, state) for state, n in counts.items()))
+    for code, start_date, end_date, error in queue.failures():
+        logger.warning('{} from {} to {} failed: {}'.format(code, start_date, end_date, error))
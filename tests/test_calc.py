@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import calc
+
+# Reference loops with the NaN semantics of the original kernels: a window
+# containing a NaN gives NaN, and the exponential average is seeded again
+# with a simple average after every gap.
+
+
+def avg_simple(v, n):
+    out = np.full(len(v), np.nan)
+    for i in range(n - 1, len(v)):
+        window = v[i-(n-1):i+1]
+        if not np.isnan(window).any():
+            out[i] = np.mean(window)
+    return out
+
+
+def avg_exp(v, n):
+    out = np.full(len(v), np.nan)
+    for i in range(n - 1, len(v)):
+        window = v[i-(n-1):i+1]
+        if np.isnan(window).any():
+            continue
+        if i == 0 or np.isnan(out[i-1]):
+            out[i] = np.mean(window)
+        else:
+            out[i] = (2 * v[i] + (n - 1) * out[i-1]) / (n + 1)
+    return out
+
+
+def stochastic_D(v, n_K, n_D):
+    numer = np.full(len(v), np.nan)
+    denom = np.full(len(v), np.nan)
+    for i in range(n_K - 1, len(v)):
+        window = v[i-(n_K-1):i+1]
+        if not np.isnan(window).any():
+            numer[i] = v[i] - window.min()
+            denom[i] = window.max() - window.min()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 100 * avg_simple(numer, n_D) / avg_simple(denom, n_D)
+
+
+def series(seed, gaps):
+    v = 1000 + np.cumsum(np.random.RandomState(seed).normal(0, 10, 300))
+    for start, stop in gaps:
+        v[start:stop] = np.nan
+    return v
+
+
+SERIES = [
+    series(0, []),
+    series(1, [(0, 7)]),                          # leading NaN run
+    series(2, [(40, 41), (100, 130)]),            # a single NaN and a long gap
+    series(3, [(0, 3), (60, 64), (62, 70), (298, 300)]),
+    series(4, [(10, 290)]),                       # shorter than the windows between gaps
+]
+
+
+def assert_same(actual, expected):
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual[~np.isnan(actual)], expected[~np.isnan(expected)], rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize("v", SERIES)
+@pytest.mark.parametrize("n", [1, 3, 12, 26])
+def test_averages_match_reference_loops(v, n):
+    assert_same(calc.calc_avg_simple(v, n), avg_simple(v, n))
+    assert_same(calc.calc_avg_exp(v, n), avg_exp(v, n))
+
+
+@pytest.mark.parametrize("v", SERIES)
+@pytest.mark.parametrize("n_K, n_D", [(5, 3), (9, 1), (14, 3)])
+def test_stochastic_matches_reference_loop(v, n_K, n_D):
+    assert_same(calc.calc_D(v, n_K, n_D), stochastic_D(v, n_K, n_D))
+
+
+def test_batch_rows_match_single_series():
+    m = np.array(SERIES)
+    for name, kernel in [("avg_simple", lambda v: calc.calc_avg_simple(v, 5)),
+                         ("avg_exp", lambda v: calc.calc_avg_exp(v, 26)),
+                         ("D", lambda v: calc.calc_D(v, 5, 3))]:
+        batch = kernel(m)
+        for row, v in zip(batch, SERIES):
+            np.testing.assert_array_equal(row, kernel(v), err_msg=name)
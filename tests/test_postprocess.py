@@ -0,0 +1,40 @@
+import zipfile
+import pytest
+import numpy as np
+import pandas as pd
+import xlsxwriter
+import postprocess
+
+
+def test_released_sheet_keeps_its_last_row(tmp_path):
+    path = str(tmp_path / "book.xlsx")
+    index = pd.date_range("2019-01-01", periods=30, freq="B", name="date")
+    df = pd.DataFrame({"end": np.arange(30) + 1000.5, "macd": np.arange(30) - 0.25}, index=index)
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+    for name in ["first", "second"]:
+        worksheet = workbook.add_worksheet(name)
+        postprocess.insert_df_to_xlsx(df, worksheet)
+        postprocess.release_sheet(worksheet)
+    workbook.close()
+
+    with zipfile.ZipFile(path) as book:
+        for sheet in ["xl/worksheets/sheet1.xml", "xl/worksheets/sheet2.xml"]:
+            xml = book.read(sheet).decode("utf-8")
+            # the header and 30 rows, the last of which constant_memory buffers
+            assert '<row r="31"' in xml
+            assert "<v>1029.5</v>" in xml and "<v>28.75</v>" in xml
+
+
+def test_memory_ceiling(monkeypatch, capsys):
+    resident = postprocess.resident_mb()
+    assert 0 < resident < 2**20
+    postprocess.MemoryCeiling(2 * resident + 100).check("7203")
+    with pytest.raises(MemoryError):
+        postprocess.MemoryCeiling(1).check("7203")
+
+    # where the resident memory cannot be measured, the ceiling is ignored
+    monkeypatch.setattr(postprocess, "resident_mb", lambda: None)
+    ceiling = postprocess.MemoryCeiling(1)
+    ceiling.check("7203")
+    assert ceiling.limit is None
+    assert "ignored" in capsys.readouterr().err
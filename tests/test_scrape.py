@@ -0,0 +1,97 @@
+import os
+import datetime
+import numpy as np
+import pytest
+import requests
+import config
+import standin
+import scrape
+import store
+from cache import PageCache, CacheMissError
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixtures", "history")
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = standin.serve(FIXTURES)
+    yield server
+    server.shutdown()
+
+
+def scrape_into(tmp_path, monkeypatch, server, asynchronous):
+    monkeypatch.setattr(config, "codes", ["7203", "9984"])
+    monkeypatch.setattr(config, "store_path", str(tmp_path / "store"))
+    monkeypatch.setattr(config, "json_path", str(tmp_path / "stock_prices.json"))
+    monkeypatch.setattr(config, "journal_dir_path", str(tmp_path / "journal"))
+    scrape.main("2019-01-01", "2019-07-05", 1, 0, asynchronous, concurrency=4, rate=0, parsers=1,
+                url=server.url)
+    prices = store.PriceStore(config.store_path)
+    return {code: (prices.name(code), prices.read(code, mmap=False)) for code in prices.codes()}
+
+
+def test_pool_and_async_scrape_the_same_columns(tmp_path, monkeypatch, server):
+    pool = scrape_into(tmp_path / "pool", monkeypatch, server, asynchronous=False)
+    concurrent = scrape_into(tmp_path / "async", monkeypatch, server, asynchronous=True)
+
+    assert {code: len(columns["date"]) for code, (name, columns) in pool.items()} == {"7203": 50, "9984": 15}
+    assert sorted(concurrent) == sorted(pool)
+    for code, (name, columns) in pool.items():
+        assert concurrent[code][0] == name
+        for field, dtype in store.FIELDS:
+            np.testing.assert_array_equal(concurrent[code][1][field], columns[field])
+
+
+def test_incremental_scrape_leaves_no_hole(tmp_path):
+    prices = store.PriceStore(str(tmp_path))
+    prices.write("7203", "Toyota", {field: np.zeros(1, dtype=dtype) if field != "date"
+                                    else np.array(["2019-01-04"], dtype=dtype)
+                                    for field, dtype in store.FIELDS})
+    prices.write("9984", "SoftBank", {field: np.zeros(1, dtype=dtype) if field != "date"
+                                      else np.array(["2019-07-05"], dtype=dtype)
+                                      for field, dtype in store.FIELDS})
+    start_dates = scrape.specify_start_dates(prices, ["7203", "9984", "1605"], "2019-06-05", "2019-07-05")
+    assert start_dates == {"7203": "2019-01-05", "1605": "2019-06-05"}
+
+
+def test_only_parsed_pages_are_cached(tmp_path):
+    pages = tmp_path / "pages"
+    pages.mkdir()
+    # a throttled request gets a page without the table of prices
+    (pages / "1301_1.html").write_text("<html><body>Too many requests</body></html>")
+    throttling = standin.serve(str(pages))
+    try:
+        cache = PageCache(str(tmp_path / "cache"))
+        retry = scrape.Retry(retries=1, backoff=0)
+        throttled = scrape.specify_url("1301", "2019-01-01", "2019-07-05", 1, throttling.url)
+        missing = scrape.specify_url("0000", "2019-01-01", "2019-07-05", 1, throttling.url)
+        with pytest.raises(ValueError):
+            scrape.fetch_page(throttled, "1301", cache, retry)
+        with pytest.raises(requests.HTTPError):
+            scrape.fetch_page(missing, "0000", cache, retry)
+        assert throttling.n_requests == 3
+        assert cache.get(throttled) is None
+        assert cache.get(missing) is None
+    finally:
+        throttling.shutdown()
+
+
+def test_cached_pages_of_today_expire(tmp_path, server):
+    cache = PageCache(str(tmp_path), ttl=0)
+    today = datetime.date.today().isoformat()
+    past = scrape.specify_url("7203", "2019-01-01", "2019-07-05", 1, server.url)
+    current = scrape.specify_url("7203", "2019-01-01", today, 1, server.url)
+    n_requests = server.n_requests
+    for url in [past, current, past, current]:
+        columns, company, next_found = scrape.fetch_page(url, "7203", cache)
+        assert len(columns["date"]) > 0
+    # the page of a past period is fetched once, the page covering today every time
+    assert server.n_requests - n_requests == 3
+
+
+def test_offline_cache_misses_raise(tmp_path, server):
+    url = scrape.specify_url("7203", "2019-01-01", "2019-07-05", 1, server.url)
+    n_requests = server.n_requests
+    with pytest.raises(CacheMissError):
+        scrape.fetch_page(url, "7203", PageCache(str(tmp_path), offline=True))
+    assert server.n_requests == n_requests
@@ -0,0 +1,43 @@
+import json
+import store
+
+
+def legacy_database(path, codes):
+    data = {code: {'name': 'company {}'.format(code),
+                   'data': {'2019-07-0{}'.format(day): {'start': 100. + day, 'end': 101. + day,
+                                                      'low': 99. + day, 'high': 102. + day,
+                                                      'volumn': 1000 * day, 'end_adj': 101. + day}
+                            for day in range(1, 4)}}
+            for code in codes}
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def test_interrupted_migration_is_resumed(tmp_path, monkeypatch):
+    json_path = str(tmp_path / 'stock_prices.json')
+    root = str(tmp_path / 'store')
+    legacy_database(json_path, ['1301', '7203', '9984'])
+
+    # the migration dies after writing the first code
+    write = store.PriceStore.write
+    def dying_write(self, code, name, columns):
+        if code == '7203':
+            raise KeyboardInterrupt
+        write(self, code, name, columns)
+    monkeypatch.setattr(store.PriceStore, 'write', dying_write)
+    try:
+        store.open_store(root, json_path)
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.setattr(store.PriceStore, 'write', write)
+    assert store.PriceStore(root).codes() == ['1301']
+    assert 'migrated' not in store.PriceStore(root).info()
+
+    prices = store.open_store(root, json_path)
+    assert prices.codes() == ['1301', '7203', '9984']
+    assert prices.version('1301') == (0, 3)
+    assert 'migrated' in prices.info()
+
+    # once marked, the legacy database is left alone
+    prices.write('9984', 'company 9984', {key: value[:1] for key, value in prices.read('9984', mmap=False).items()})
+    assert store.open_store(root, json_path).length('9984') == 1
@@ -0,0 +1,40 @@
+import numpy as np
+import store
+import stream
+
+
+def columns(dates, values):
+    cols = {field: np.asarray(values, dtype=dtype) for field, dtype in store.FIELDS[1:]}
+    cols["date"] = np.asarray(dates, dtype=store.DTYPES["date"])
+    cols["div"] = np.zeros(len(dates), dtype=store.DTYPES["div"])
+    return cols
+
+
+def warmed_up(prices, code):
+    indicators = stream.Indicators()
+    indicators.warm_up(prices.read(code)["end_adj"])
+    return indicators.last
+
+
+def test_update_promises_follows_appended_and_rewritten_bars(tmp_path):
+    prices = store.PriceStore(str(tmp_path))
+    dates = np.arange("2019-01-01", "2019-04-01", dtype="datetime64[D]")
+    values = 100 + 10 * np.sin(np.arange(len(dates)) / 7.)
+    prices.write("7203", "Toyota", columns(dates[:60], values[:60]))
+    stream.update_promises(prices, ["7203"])
+
+    # appended bars are taken one by one
+    prices.merge("7203", "Toyota", columns(dates[60:], values[60:]))
+    stream.update_promises(prices, ["7203"])
+    indicators, version = stream.load(stream.state_path(prices, "7203"))
+    assert version == list(prices.version("7203"))
+    for k, v in warmed_up(prices, "7203").items():
+        assert np.isclose(indicators.last[k], v)
+
+    # the history re-adjusted after a split is calculated again
+    prices.merge("7203", "Toyota", columns(dates, values / 2))
+    stream.update_promises(prices, ["7203"])
+    indicators, version = stream.load(stream.state_path(prices, "7203"))
+    assert version == list(prices.version("7203"))
+    for k, v in warmed_up(prices, "7203").items():
+        assert np.isclose(indicators.last[k], v)
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+import visualize
+
+
+def frame(start, values):
+    index = pd.date_range(start, periods=len(values), freq="B")
+    return pd.DataFrame({"macd": values, "signal": values[::-1]}, index=index)
+
+
+WIDE = frame("2019-01-01", 50 * np.sin(np.arange(60) / 5.))
+EMPTY = frame("2019-04-01", np.full(20, np.nan))
+NARROW = frame("2019-04-01", np.linspace(-2., 3., 20))
+
+
+@pytest.mark.parametrize("previous, df", [(WIDE, EMPTY), (EMPTY, NARROW), (WIDE, NARROW)])
+def test_reused_renderer_draws_like_a_fresh_one(tmp_path, previous, df):
+    reused = visualize.ChartRenderer()
+    reused.draw_indicators(previous, ["macd", "signal"], str(tmp_path / "previous.png"))
+    reused.draw_indicators(df, ["macd", "signal"], str(tmp_path / "reused.png"))
+    fresh = visualize.ChartRenderer()
+    fresh.draw_indicators(df, ["macd", "signal"], str(tmp_path / "fresh.png"))
+    reused.close()
+    fresh.close()
+    assert (tmp_path / "reused.png").read_bytes() == (tmp_path / "fresh.png").read_bytes()
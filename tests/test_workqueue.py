@@ -0,0 +1,42 @@
+import os
+import time
+import multiprocessing
+import pytest
+import standin
+import store
+import workqueue
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fixtures", "history")
+
+
+@pytest.fixture
+def slow_server(monkeypatch):
+    do_GET = standin.HistoryHandler.do_GET
+
+    def slow_GET(self):
+        time.sleep(0.5)
+        do_GET(self)
+
+    monkeypatch.setattr(standin.HistoryHandler, "do_GET", slow_GET)
+    server = standin.serve(FIXTURES)
+    yield server
+    server.shutdown()
+
+
+def test_heartbeat_keeps_a_task_longer_than_its_lease(tmp_path, slow_server):
+    # the 3 pages of 7203 take 1.5 seconds, longer than a lease of 1 second
+    path = str(tmp_path / "queue.sqlite")
+    queue = workqueue.WorkQueue(path, lease=1., max_attempts=1)
+    assert workqueue.enqueue(queue, ["7203", "9984"], "2019-01-01", "2019-07-05") == 2
+    kwargs = dict(sleeptime=0, base_url=slow_server.url, lease=1., max_attempts=1, poll=0.1)
+    workers = [multiprocessing.Process(target=workqueue.work, args=(path,), kwargs=kwargs) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert queue.failures() == []
+    assert queue.counts()["done"] == 2
+    prices = store.PriceStore(str(tmp_path / "store"))
+    assert workqueue.merge(queue, prices) == 2
+    assert {code: prices.length(code) for code in prices.codes()} == {"7203": 50, "9984": 15}